@@ -1,10 +1,16 @@
-from flask import Flask, render_template, request, jsonify, session # session をインポート
+from flask import Flask, render_template, request, jsonify, session, Response # session をインポート
 import json
-import random
 import os
-from gemini import initialize_gemini, generate_interpretation # gemini.pyから関数をインポート
+import re
+import time
+from gemini import initialize_gemini, GenerationError # gemini.pyから関数をインポート
 import secrets # secret_key生成用
 import markdown # markdownライブラリをインポート
+from shared_cache import InterpretationCache # ワーカー間で共有する解釈キャッシュ
+from locales import get_locale_pack, AVAILABLE_LOCALES, DEFAULT_LOCALE # 言語ごとのカードデータ・プロンプト
+from reading import draw_card as draw_card_from, build_interpretation_prompt, generate_reading # 占いの共通処理
+from model_router import router # モデル選択とそのメトリクス
+from job_queue import JobQueue # 最終総合解釈のバックグラウンド実行
 
 app = Flask(__name__)
 # --- セッションのための Secret Key 設定 ---
@@ -16,33 +22,54 @@ if not initialize_gemini():
     print("警告: Geminiの初期化に失敗しました。解釈機能は利用できません。")
     # 必要に応じて、ここでアプリケーションを終了させるか、警告を表示するなどの処理を追加
 
-# --- カードデータの読み込み ---
-def load_card_data(filepath):
-    # スクリプトのディレクトリからの相対パスでファイルを開く
-    script_dir = os.path.dirname(__file__)
-    abs_file_path = os.path.join(script_dir, filepath)
-    try:
-        with open(abs_file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print(f"エラー: ファイルが見つかりません - {abs_file_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"エラー: JSONファイルの解析に失敗しました - {abs_file_path}")
-        return None
-
-all_cards_data = load_card_data('cards_meaning/all_cards.json')
+# --- ワーカー間の共有データ ---
+# gunicorn を --preload (gunicorn.conf.py 参照) で起動すると、ここまでがフォーク前に実行される。
+# 既定の言語のデッキはここで mmap した読み取り専用スナップショットとして開き、全ワーカーで共有する。
+# 他の言語のロケールパックは最初に使われたときに読み込む (locales.py)。
+# 解釈キャッシュは SQLite(WAL) のファイルで、どのワーカーからも読み書きできる。
+os.makedirs(app.instance_path, exist_ok=True)
+get_locale_pack(DEFAULT_LOCALE)
+interpretation_cache = InterpretationCache(
+    os.environ.get('TAROT_CACHE_PATH', os.path.join(app.instance_path, 'interpretation_cache.sqlite3'))
+)
+# モデル選択の回数も同じファイルで全ワーカー分を数える (/metrics がどのワーカーに届いても同じ値になる)
+router.use_counter_store(interpretation_cache)
+
+# --- カード画像の配信 ---
+# static/cards/ は build_card_atlas.py の生成物。ファイル名に内容のハッシュを含むので変更されない。
+FINGERPRINTED_CARD_ASSET = re.compile(r'^/static/cards/[^/]+\.[0-9a-f]{12}\.(webp|avif)$')
+
+@app.after_request
+def set_card_asset_cache_headers(response):
+    if FINGERPRINTED_CARD_ASSET.match(request.path) and response.status_code == 200:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    elif request.path == '/static/cards/manifest.json':
+        response.headers['Cache-Control'] = 'no-cache' # 中身は変わりうるので毎回 ETag で確認する
+    return response
+
+# --- 言語の選択 ---
+def current_locale():
+    """セッションの言語 (/?lang=en のように選ぶ)。未設定なら既定の言語"""
+    locale = session.get('locale')
+    return locale if locale in AVAILABLE_LOCALES else DEFAULT_LOCALE
 
 @app.route('/')
 def index():
-    if all_cards_data is None:
+    # ?lang=en のように指定された場合はセッションに保存する (言語が変わったら占いはリセット)
+    lang = request.args.get('lang')
+    if lang in AVAILABLE_LOCALES and lang != session.get('locale'):
+        session['locale'] = lang
+        session.pop('drawn_cards', None)
+    pack = get_locale_pack(current_locale())
+    if pack is None:
         return "カードデータの読み込みに失敗しました。", 500
-    return render_template('index.html')
+    return render_template('index.html', locale=pack.code, positions=pack.positions)
 
 # カードを1枚引くAPIエンドポイント (セッション管理)
 @app.route('/draw_card', methods=['POST'])
 def draw_card():
-    if all_cards_data is None:
+    pack = get_locale_pack(current_locale())
+    if pack is None:
         return jsonify({"error": "カードデータが読み込まれていません。"}), 500
 
     # セッションから引いたカードのリストを取得、なければ初期化
@@ -53,19 +80,7 @@ def draw_card():
         return jsonify({"error": "すでに5枚のカードを引いています。", "drawn_cards": drawn_cards, "card_count": len(drawn_cards)}), 400
 
     # 新しいカードを引く
-    card_info = random.choice(all_cards_data)
-    card_name = card_info.get("name", "名前不明")
-    orientation = random.choice(["正位置", "逆位置"])
-    if orientation == "正位置":
-        meaning = card_info.get("meaning_up", "意味が見つかりません")
-    else:
-        meaning = card_info.get("meaning_rev", "意味が見つかりません")
-
-    new_card = {
-        "card_name": card_name,
-        "orientation": orientation,
-        "meaning": meaning
-    }
+    new_card = draw_card_from(pack)
 
     # 引いたカードをセッションに追加
     drawn_cards.append(new_card)
@@ -84,6 +99,29 @@ def reset_session():
     return jsonify({"message": "占いをリセットしました。"})
 
 
+# --- 解釈の生成 (LLM呼び出し + HTML変換) ---
+def render_interpretation(pack, interpretation_type, prompt):
+    """プロンプトからGeminiの応答を取得し、HTMLに変換して返す"""
+    # --- Geminiから解釈/反応を取得 (同じプロンプトなら共有キャッシュを使う) ---
+    cache_key = interpretation_cache.make_key(pack.system_instruction, pack.prompt_prefixes[interpretation_type], prompt)
+    interpretation_markdown = interpretation_cache.get(cache_key)
+    if interpretation_markdown is None:
+        try:
+            interpretation_markdown = generate_reading(pack, interpretation_type, prompt)
+            interpretation_cache.set(cache_key, interpretation_markdown)
+        except GenerationError as e:
+            # エラーはキャッシュせず、その言語のエラー文を解釈の代わりに表示する
+            interpretation_markdown = pack.messages['generation_failed'].format(error=e)
+
+    # --- MarkdownをHTMLに変換 ---
+    try:
+        interpretation_html = markdown.markdown(interpretation_markdown, extensions=['fenced_code', 'nl2br'])
+    except Exception as e:
+        print(f"MarkdownのHTML変換中にエラー: {e}")
+        interpretation_html = f"<p>解釈の表示中にエラーが発生しました。</p><pre>{interpretation_markdown}</pre>"
+    return interpretation_html
+
+
 # LLMによる解釈を生成するAPIエンドポイント (個別カード解釈と最終解釈に対応)
 @app.route('/interpret', methods=['POST'])
 def interpret_cards():
@@ -91,116 +129,13 @@ def interpret_cards():
     if not drawn_cards:
         return jsonify({"error": "カードがまだ引かれていません。"}), 400
 
-    data = request.get_json()
-    user_question = data.get('question', '特に質問はありません。')
-    interpretation_type = data.get('type', 'final') # 'single', 'feedback', 'final'
-    card_index = data.get('card_index', -1) # 'single', 'feedback' で使用
-    user_feedback = data.get('feedback', '') # ★キー名を 'user_feedback' から 'feedback' に変更
-    # 'feedback' と 'final' で使用する対話履歴 (各カードごとのターンの配列)
-    card_interactions = data.get('card_interactions', [])
-
-    # ギリシャ十字のポジション定義
-    positions = [
-        "1. 現在の状況、状態", "2. 障害、原因", "3. 現状維持で予想される傾向",
-        "4. 問題解決のための対策", "5. 最終結果"
-    ]
-
-    prompt = ""
-    if interpretation_type == 'single' and 0 <= card_index < len(drawn_cards):
-        # --- 個別カード解釈用プロンプト (変更なし) ---
-        target_card = drawn_cards[card_index]
-        position_name = positions[card_index] if card_index < len(positions) else f"{card_index+1}枚目"
-        prompt_context = ""
-        if card_index > 0:
-            prompt_context += "これまでのカード:\n"
-            for i in range(card_index):
-                prev_card = drawn_cards[i]
-                prev_pos_name = positions[i] if i < len(positions) else f"{i+1}枚目"
-                prompt_context += f"- {prev_pos_name}: {prev_card['card_name']} ({prev_card['orientation']})\n"
-            prompt_context += "\n"
-        prompt = f"""タロット占いの{card_index+1}枚目（{position_name}）として以下のカードが出ました。
-カード: {target_card['card_name']} ({target_card['orientation']})
-基本的な意味: {target_card['meaning']}
-
-{prompt_context}相談者の質問: 「{user_question}」
-
-このカードが{position_name}の位置に出た意味について、タロット占い師の視点から**200字以内で簡潔に**解説してください。可能であれば、これまでのカードとの関連性も少し触れてください。
-応答はMarkdown形式（見出し、段落、リストなどを使用）で、自然な文章で記述してください。テーブル形式は使用しないでください。"""
-
-    elif interpretation_type == 'feedback' and 0 <= card_index < len(drawn_cards) and user_feedback and card_interactions: # 'reaction' を 'feedback' に変更
-        # --- AI反応生成用プロンプト (複数回の対話を考慮) ---
-        target_card = drawn_cards[card_index]
-        position_name = positions[card_index] if card_index < len(positions) else f"{card_index+1}枚目"
-
-        # このカードに関する直近の対話履歴を構築
-        interaction_log = ""
-        for turn in card_interactions:
-            if turn.get('interpretation'): # 最初の解釈
-                interaction_log += f"あなたの最初の解釈: 「{turn['interpretation']}」\n"
-            if turn.get('feedback'):
-                interaction_log += f"相談者の反応: 「{turn['feedback']}」\n"
-            if turn.get('reaction'):
-                interaction_log += f"あなたの応答: 「{turn['reaction']}」\n"
-
-        prompt = f"""タロット占いの{card_index+1}枚目（{position_name}: {target_card['card_name']} {target_card['orientation']}）について、相談者と以下の対話を行いました。
---- 対話履歴 ---
-{interaction_log}
----
-相談者の最新の反応: 「{user_feedback}」
-
-タロット占い師として、これまでの流れと相談者の最新の反応を踏まえ、**共感や短い問いかけ、補足など、簡潔な言葉で**応答してください。**100字以内**でお願いします。
-応答はMarkdown形式で、自然な文章で記述してください。"""
-
-    elif interpretation_type == 'final' and len(drawn_cards) == 5 and card_interactions: # card_interactions は全カードの対話履歴の配列
-        # --- 最終総合解釈用プロンプト (複数回の対話履歴を反映) ---
-        prompt_cards_info = ""
-        for i, card in enumerate(drawn_cards):
-            position_name = positions[i] if i < len(positions) else f"{i+1}枚目"
-            prompt_cards_info += f"{position_name}: {card['card_name']} ({card['orientation']}) - 基本的な意味: {card['meaning']}\n"
-
-        prompt_interaction_summary = "これまでの対話の概要:\n"
-        # card_interactions は [[card0_turn1, card0_turn2,...], [card1_turn1,...], ...] の形式を想定
-        for i, card_history in enumerate(card_interactions):
-            if not card_history: continue # 対話がないカードはスキップ
-            position_name = positions[i] if i < len(positions) else f"{i+1}枚目"
-            prompt_interaction_summary += f"--- {position_name} ({drawn_cards[i]['card_name']}) ---\n"
-            for turn_num, turn in enumerate(card_history):
-                if turn.get('interpretation'):
-                    prompt_interaction_summary += f"あなたの解釈: {turn['interpretation'][:100]}...\n"
-                if turn.get('feedback'):
-                    prompt_interaction_summary += f"相談者の反応 {turn_num+1}: {turn['feedback']}\n"
-                if turn.get('reaction'):
-                    prompt_interaction_summary += f"あなたの応答 {turn_num+1}: {turn['reaction']}\n"
-            prompt_interaction_summary += "\n"
-
-
-        prompt = f"""以下の5枚のタロットカードがギリシャ十字スプレッドで出ました。
-
-{prompt_cards_info}
-相談者の質問: 「{user_question}」
-
-{prompt_interaction_summary}
-上記のカード、質問、そして**各カードに関する相談者との複数回にわたる対話全体を踏まえ**、タロット占い師の視点から**総合的な解釈と最終的なアドバイス**を生成してください。
-応答はMarkdown形式で、以下のような形式で記述してください:
-- 全体の概要
-- 各カードと対話から読み取れることのまとめ（対話の流れも考慮）
-- カード間の関連性と対話の流れについての考察
-- 最終的なアドバイス
-
-**注意:** 結果をMarkdownのテーブル形式 (`| ... | ... |`) で表示しないでください。自然な文章で記述してください。"""
-    else:
-        # 不正なリクエスト
+    pack = get_locale_pack(current_locale())
+    if pack is None:
+        return jsonify({"error": "カードデータが読み込まれていません。"}), 500
+    interpretation_type, prompt = build_interpretation_prompt(pack, drawn_cards, request.get_json())
+    if prompt is None:
         return jsonify({"error": "解釈に必要な情報が不足しているか、不正なリクエストです。"}), 400
-
-    # --- Geminiから解釈/反応を取得 ---
-    interpretation_markdown = generate_interpretation(prompt)
-
-    # --- MarkdownをHTMLに変換 ---
-    try:
-        interpretation_html = markdown.markdown(interpretation_markdown, extensions=['fenced_code', 'nl2br'])
-    except Exception as e:
-        print(f"MarkdownのHTML変換中にエラー: {e}")
-        interpretation_html = f"<p>解釈の表示中にエラーが発生しました。</p><pre>{interpretation_markdown}</pre>"
+    interpretation_html = render_interpretation(pack, interpretation_type, prompt)
 
     # --- レスポンスを返す (キー名をタイプによって変更) ---
     if interpretation_type == 'feedback':
@@ -209,6 +144,115 @@ def interpret_cards():
         return jsonify({"interpretation_html": interpretation_html}) # それ以外は interpretation_html
 
 
+# --- 最終総合解釈のジョブキュー ---
+# 最終解釈は最も時間がかかるため、HTTPリクエストを開いたまま待たせずにジョブとして実行する。
+# ジョブはファイルに保存されるので、ワーカーが再起動しても続きから処理される。
+def run_interpretation_job(payload):
+    pack = get_locale_pack(payload.get('locale'))
+    if pack is None:
+        raise RuntimeError("カードデータが読み込まれていません。") # JOB_MAX_ATTEMPTS 回まで再試行され、それでも失敗したら failed になる
+    return {"interpretation_html": render_interpretation(pack, payload['type'], payload['prompt'])}
+
+JOB_EVENTS_ENABLED = os.environ.get('TAROT_JOB_EVENTS') == 'sse' # SSEで結果を送るか (下の /events 参照)
+
+interpretation_jobs = JobQueue(
+    os.environ.get('TAROT_JOBS_PATH', os.path.join(app.instance_path, 'jobs.sqlite3')),
+    handler=run_interpretation_job,
+    num_workers=int(os.environ.get('TAROT_JOB_WORKERS', '2')),
+)
+
+@app.before_request
+def start_job_workers():
+    # フォーク後のワーカープロセスごとにジョブ処理スレッドを起動する (起動済みなら何もしない)
+    interpretation_jobs.ensure_started()
+
+# 最終総合解釈をジョブとして登録するAPIエンドポイント (すぐにジョブIDを返す)
+@app.route('/interpret/jobs', methods=['POST'])
+def submit_interpretation_job():
+    drawn_cards = session.get('drawn_cards', [])
+    if not drawn_cards:
+        return jsonify({"error": "カードがまだ引かれていません。"}), 400
+
+    pack = get_locale_pack(current_locale())
+    if pack is None:
+        return jsonify({"error": "カードデータが読み込まれていません。"}), 500
+    data = dict(request.get_json(), type='final')
+    interpretation_type, prompt = build_interpretation_prompt(pack, drawn_cards, data)
+    if prompt is None:
+        return jsonify({"error": "解釈に必要な情報が不足しているか、不正なリクエストです。"}), 400
+
+    job_id = interpretation_jobs.submit({"type": interpretation_type, "prompt": prompt, "locale": pack.code})
+    job = {"job_id": job_id, "status_url": f"/interpret/jobs/{job_id}"}
+    if JOB_EVENTS_ENABLED:
+        job["events_url"] = f"/interpret/jobs/{job_id}/events"
+    return jsonify(job), 202
+
+# ジョブの状態・結果を返すAPIエンドポイント (ポーリング用)
+@app.route('/interpret/jobs/<job_id>')
+def get_interpretation_job(job_id):
+    job = interpretation_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません。"}), 404
+    return jsonify(job)
+
+# ジョブの状態を Server-Sent Events で送り、完了したら結果のHTMLを送るエンドポイント
+# 接続中はずっとリクエストを占有するので、スレッド・非同期ワーカー (gunicorn -k gthread / gevent) 向け。
+# 同期ワーカー (gunicorn.conf.py の既定) ではストリームごとにワーカーが1つ塞がり、
+# timeout を超えるとジョブ処理中のワーカーごと再起動されてしまう。
+# そのため TAROT_JOB_EVENTS=sse のときだけ events_url を返し、既定ではブラウザはポーリングする。
+@app.route('/interpret/jobs/<job_id>/events')
+def stream_interpretation_job(job_id):
+    if interpretation_jobs.get(job_id) is None:
+        return jsonify({"error": "ジョブが見つかりません。"}), 404
+
+    def events():
+        last_status = None
+        while True:
+            job = interpretation_jobs.get(job_id)
+            if job is None:
+                return
+            if job['status'] in ('done', 'failed'):
+                yield f"event: {job['status']}\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                return
+            if job['status'] != last_status:
+                yield f"event: status\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                last_status = job['status']
+            else:
+                yield ": keep-alive\n\n" # プロキシに接続を切られないようにする
+            time.sleep(1)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# モデル選択・解釈キャッシュ・ジョブキューのメトリクス (Prometheusのテキスト形式)
+@app.route('/metrics')
+def metrics():
+    cache_stats = interpretation_cache.stats()
+    lines = [
+        "# HELP tarot_interpretation_cache_hit_rate Shared interpretation cache hit rate (all workers).",
+        "# TYPE tarot_interpretation_cache_hit_rate gauge",
+        f"tarot_interpretation_cache_hit_rate {cache_stats['hit_rate']:.3f}",
+    ]
+    job_stats = interpretation_jobs.stats()
+    lines += [
+        "# HELP tarot_job_queue_depth Final interpretation jobs waiting in the queue.",
+        "# TYPE tarot_job_queue_depth gauge",
+        f"tarot_job_queue_depth {job_stats['queued']}",
+        "# HELP tarot_job_running Final interpretation jobs being processed.",
+        "# TYPE tarot_job_running gauge",
+        f"tarot_job_running {job_stats['running']}",
+        "# HELP tarot_job_oldest_wait_seconds Age of the oldest queued job.",
+        "# TYPE tarot_job_oldest_wait_seconds gauge",
+        f"tarot_job_oldest_wait_seconds {job_stats['oldest_wait_seconds']:.3f}",
+        "# HELP tarot_job_avg_wait_seconds Average queue wait of jobs started in the last hour.",
+        "# TYPE tarot_job_avg_wait_seconds gauge",
+        f"tarot_job_avg_wait_seconds {job_stats['avg_wait_seconds']:.3f}",
+    ]
+    body = router.metrics_text() + "\n".join(lines) + "\n"
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     # 仮想環境のPythonインタープリタで実行されるようにする
     # 通常、`flask run` コマンドを使用するか、
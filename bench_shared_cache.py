@@ -0,0 +1,114 @@
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+
+from shared_cache import load_deck_snapshot, InterpretationCache
+
+# ワーカー数を増やしたときの「デッキのメモリ」と「キャッシュヒット率」を計測する
+# 使い方: python bench_shared_cache.py [最大ワーカー数]
+#
+# デッキ: 各ワーカーが起動後に自分で JSON を読み込む場合 (preload なし) と、
+#         フォーク前に開いたスナップショット (mmap) を使う場合を比べる。
+#         ワーカーの起動直後からデッキを読み終わるまでに増えた private メモリを「ワーカーごとの増分」とする。
+# キャッシュ: ワーカーごとの dict と、共有の SQLite キャッシュのヒット率を比べる。
+#         (SQLite の接続自体がワーカーごとに数MBのメモリを使うので、キャッシュのメモリは比べない)
+REQUESTS_PER_WORKER = 200
+DISTINCT_PROMPTS = 4
+CARDS_PATH = "cards_meaning/all_cards.json"
+
+
+def memory_kb():
+    """
+    このプロセスだけが使っているメモリ (Private_Clean + Private_Dirty) を返す。取れなければ RSS。
+    PSS は他のワーカーの起動・終了で按分が変わって揺れるので使わない。
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith(("Private_Clean:", "Private_Dirty:")))
+    except OSError:
+        pass
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def deck_worker(snapshot, results):
+    before = memory_kb()
+    if snapshot is None:
+        with open(CARDS_PATH, "r", encoding="utf-8") as f:
+            deck = json.load(f)
+    else:
+        deck = snapshot
+    # 占いと同じようにカードを引いて意味を読む
+    for i in range(REQUESTS_PER_WORKER):
+        card = deck[i % len(deck)]
+        card.get("meaning_up", "")
+    results.put(memory_kb() - before)
+
+
+def cache_worker(cache_path, shared, seed, results):
+    random.seed(seed)
+    cache = InterpretationCache(cache_path)
+    local_cache = {}
+    hits = 0
+    for _ in range(REQUESTS_PER_WORKER):
+        prompt = f"{random.randrange(78)}-{random.randrange(DISTINCT_PROMPTS)}"
+        if shared:
+            key = cache.make_key(prompt)
+            if cache.get(key) is not None:
+                hits += 1
+            else:
+                cache.set(key, prompt * 20)
+        else:
+            if prompt in local_cache:
+                hits += 1
+            else:
+                local_cache[prompt] = prompt * 20
+    results.put(hits)
+
+
+def fork_all(num_workers, target, args_for):
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    procs = [ctx.Process(target=target, args=args_for(i) + (results,)) for i in range(num_workers)]
+    for p in procs:
+        p.start()
+    values = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return values
+
+
+def run_deck(num_workers, snapshot_mode):
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = None
+        if snapshot_mode:
+            with open(CARDS_PATH, "r", encoding="utf-8") as f:
+                snapshot = load_deck_snapshot(json.load(f), os.path.join(tmp, "all_cards.snapshot"))
+        deltas = fork_all(num_workers, deck_worker, lambda i: (snapshot,))
+    return sum(deltas) / num_workers
+
+
+def run_cache(num_workers, shared):
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "cache.sqlite3")
+        hits = fork_all(num_workers, cache_worker, lambda i: (cache_path, shared, i))
+    return sum(hits) / (REQUESTS_PER_WORKER * num_workers)
+
+
+if __name__ == "__main__":
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    print(f"{'workers':>7} {'deck':>9} {'deck KB/worker':>15} {'cache':>7} {'hit_rate':>9}")
+    workers = 1
+    while workers <= max_workers:
+        for shared in (False, True):
+            deck_kb = run_deck(workers, shared)
+            hit_rate = run_cache(workers, shared)
+            print(f"{workers:>7} {'snapshot' if shared else 'json':>9} {deck_kb:>15.0f} "
+                  f"{'shared' if shared else 'local':>7} {hit_rate:>9.3f}")
+        workers *= 2
@@ -0,0 +1,149 @@
+import hashlib
+import io
+import json
+import os
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdf
+from PIL import Image, features
+
+# --- カード画像のアトラス生成 ---
+# cards/ のPDFから78枚のカード画像を取り出し、以下を static/cards/ に出力する。
+#   - カードごとのサムネイル (WebP)       : <カードID>.<ハッシュ>.webp
+#   - 全カードを並べたスプライトアトラス   : atlas.<ハッシュ>.webp (Pillowが対応していれば .avif も)
+#   - アトラス上の座標を書いたマニフェスト : manifest.json (カードIDをキーにする)
+# ファイル名に内容のハッシュを含めるので、Flask側では変更されない (immutable) ものとして配信できる。
+# カードIDは cards_meaning/all_cards.json でのインデックス。
+# 使い方: python build_card_atlas.py
+
+PDF_FILES = ["card", "takara-tarot-cups", "takara-tarot-swords", "takara-tarot-wands", "takara-tarot-PENTACLES"]
+PDF_DIR = "cards"
+CARDS_JSON = "cards_meaning/all_cards.json"
+OUTPUT_DIR = "static/cards"
+THUMB_SIZE = (120, 208) # 元画像はおよそ 150x260
+ATLAS_COLUMNS = 13
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+
+
+def extract_card_images(pdf_name):
+    """
+    PDFから (カード名, 画像のバイト列) のリストを返す。
+    画像の描画順は見出しの順と一致しないページがあるため、
+    ページ上の縦位置で【カード名】の見出しと画像を対応させる。
+    """
+    reader = pypdf.PdfReader(os.path.join(PDF_DIR, f"{pdf_name}.pdf"))
+    results = []
+    for page_num, page in enumerate(reader.pages):
+        image_ys = {} # 画像の名前 -> 縦位置
+        heading_ys = [] # 見出しの縦位置 (テキストの出現順)
+
+        def visit_operand(operator, args, cm, tm):
+            if operator == b"Do":
+                image_ys[str(args[0]).lstrip("/")] = cm[5]
+
+        def visit_text(text, cm, tm, font_dict, font_size):
+            if "【" in text:
+                heading_ys.append(cm[5])
+
+        text = page.extract_text(visitor_operand_before=visit_operand, visitor_text=visit_text) or ""
+        names = [m.group(1).strip() for m in re.finditer(r"^\s*【(.+?)】\s*$", text, re.MULTILINE)]
+        images = [image for image in page.images if os.path.splitext(image.name)[0] in image_ys]
+        if len(names) != len(images) or len(names) != len(heading_ys):
+            print(f"警告: {pdf_name}.pdf の{page_num + 1}ページ目でカード名({len(names)})と画像({len(images)})の数が一致しません。")
+            continue
+
+        # PDFの座標は下から上なので、縦位置の大きい順 = ページの上から順
+        names = [name for _, name in sorted(zip(heading_ys, names), key=lambda x: -x[0])]
+        images.sort(key=lambda image: -image_ys[os.path.splitext(image.name)[0]])
+        for name, image in zip(names, images):
+            results.append((name, image.data))
+    return results
+
+
+def make_thumbnail(image_bytes):
+    """カード画像を THUMB_SIZE に収まるよう縮小し、余白を白で埋めた画像を返す"""
+    with Image.open(io.BytesIO(image_bytes)) as src:
+        src = src.convert("RGB")
+        src.thumbnail(THUMB_SIZE, Image.LANCZOS)
+        thumb = Image.new("RGB", THUMB_SIZE, "white")
+        thumb.paste(src, ((THUMB_SIZE[0] - src.width) // 2, (THUMB_SIZE[1] - src.height) // 2))
+        return thumb
+
+
+def encode_image(image, image_format, quality):
+    buf = io.BytesIO()
+    image.save(buf, format=image_format, quality=quality, method=6) if image_format == "WEBP" \
+        else image.save(buf, format=image_format, quality=quality)
+    return buf.getvalue()
+
+
+def write_fingerprinted(data, stem, ext):
+    """内容のハッシュをファイル名に含めて保存し、ファイル名を返す"""
+    filename = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+    with open(os.path.join(OUTPUT_DIR, filename), "wb") as f:
+        f.write(data)
+    return filename
+
+
+def build_atlas():
+    with open(CARDS_JSON, "r", encoding="utf-8") as f:
+        cards = json.load(f)
+    # PDFとJSONで「⼥」(部首) と「女」のように異なる文字が混ざっているため、NFKC正規化して照合する
+    card_ids = {unicodedata.normalize("NFKC", card["name"]): i for i, card in enumerate(cards)}
+
+    # PDFごとに並列で画像を取り出す
+    print("PDFからカード画像を取り出しています...")
+    with ProcessPoolExecutor() as executor:
+        extracted = [item for items in executor.map(extract_card_images, PDF_FILES) for item in items]
+
+    thumbs = {}
+    for name, image_bytes in extracted:
+        key = unicodedata.normalize("NFKC", name)
+        if key not in card_ids:
+            print(f"警告: all_cards.json にないカード名です: {name}")
+            continue
+        thumbs[card_ids[key]] = make_thumbnail(image_bytes)
+    missing = [cards[i]["name"] for i in range(len(cards)) if i not in thumbs]
+    if missing:
+        print(f"警告: 画像が見つからないカードがあります: {missing}")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # 前回の生成物は削除する (ハッシュが変わると古いファイルが残るため)
+    for filename in os.listdir(OUTPUT_DIR):
+        os.remove(os.path.join(OUTPUT_DIR, filename))
+
+    # スプライトアトラス
+    width, height = THUMB_SIZE
+    rows = -(-len(cards) // ATLAS_COLUMNS)
+    atlas = Image.new("RGB", (width * ATLAS_COLUMNS, height * rows), "white")
+    manifest_cards = {}
+    for card_id, thumb in sorted(thumbs.items()):
+        x, y = (card_id % ATLAS_COLUMNS) * width, (card_id // ATLAS_COLUMNS) * height
+        atlas.paste(thumb, (x, y))
+        manifest_cards[str(card_id)] = {
+            "name": cards[card_id]["name"],
+            "x": x, "y": y, "w": width, "h": height,
+            "thumb": write_fingerprinted(encode_image(thumb, "WEBP", WEBP_QUALITY), str(card_id), "webp"),
+        }
+
+    atlas_files = {"webp": write_fingerprinted(encode_image(atlas, "WEBP", WEBP_QUALITY), "atlas", "webp")}
+    if features.check("avif"):
+        atlas_files["avif"] = write_fingerprinted(encode_image(atlas, "AVIF", AVIF_QUALITY), "atlas", "avif")
+    else:
+        print("このPillowはAVIFに対応していないため、WebPのみ出力します。")
+
+    manifest = {
+        "atlas": atlas_files,
+        "atlas_size": {"w": atlas.width, "h": atlas.height},
+        "cards": manifest_cards,
+    }
+    with open(os.path.join(OUTPUT_DIR, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    print(f"{len(manifest_cards)} 枚のカード画像を {OUTPUT_DIR} に出力しました。")
+
+
+if __name__ == "__main__":
+    build_atlas()
@@ -1,11 +1,32 @@
 from google import genai
 from google.genai import types
 import os
+import time
+import hashlib
+import threading
 from dotenv import load_dotenv
+from model_router import router # 解釈タイプごとのモデル選択
 
 # --- グローバル変数 ---
 model = None
 api_key_configured = False
+# モデル名は model_routes.json で解釈タイプごとに設定する (コンテキストキャッシュはバージョン付きのモデル名が必要)
+
+# --- コンテキストキャッシュ設定 ---
+# 環境変数 GEMINI_CONTEXT_CACHE で切り替える: "gemini" (既定) / "local" (テスト用) / "off"
+CONTEXT_CACHE_TTL_SECONDS = 3600
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = 60 # 期限切れ直前のハンドルは使わずに作り直す
+# 明示的キャッシュに必要な最小トークン数 (モデルによって異なる)。これより小さい固定部分はキャッシュを作らない
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "4096"))
+context_cache_backend = None
+_context_caches = {} # (解釈タイプ, モデル名, 固定部分のハッシュ) -> {"name", "expires_at"}
+# ジョブのワーカースレッドなどから同時に呼ばれるので、確認・作成・登録はこのロックの中で行う
+# (同時に作成すると、使われないキャッシュがTTLの間サーバーに残って課金される)
+_context_caches_lock = threading.Lock()
+
+
+class GenerationError(Exception):
+    """応答を生成できなかったことを表す例外 (利用者に見せる文言は呼び出し側で決める)"""
 
 
 # --- 初期化関数 ---
@@ -46,34 +67,201 @@ def initialize_gemini():
         model = None # エラー時はモデルをNoneに
         return False
 
+# --- コンテキストキャッシュ ---
+class GeminiContextCacheBackend:
+    """
+    Gemini API の明示的コンテキストキャッシュ (client.caches) を使うバックエンド。
+    システム指示と共通プレフィックスを一度だけアップロードし、以降はハンドル名で参照する。
+    """
+
+    def is_too_small(self, model_name, system_instruction, prefix):
+        """
+        固定部分が最小トークン数に満たないか判定する。
+        トークン数が文字数を超えることはほぼないので、文字数で足りない場合は count_tokens を呼ばない。
+        """
+        if len(system_instruction or "") + len(prefix) < CONTEXT_CACHE_MIN_TOKENS:
+            return True
+        response = model.models.count_tokens(
+            model=model_name, contents=[system_instruction or "", prefix]
+        )
+        return response.total_tokens < CONTEXT_CACHE_MIN_TOKENS
+
+    def create(self, model_name, system_instruction, prefix, ttl_seconds, display_name):
+        cache = model.caches.create(
+            model=model_name,
+            config=types.CreateCachedContentConfig(
+                display_name=display_name,
+                system_instruction=system_instruction,
+                contents=[prefix],
+                ttl=f"{ttl_seconds}s",
+            ),
+        )
+        return cache.name
+
+    def request_args(self, handle, system_instruction, prefix, prompt):
+        """generate_content に渡す contents と config を返す"""
+        if handle:
+            return prompt, types.GenerateContentConfig(cached_content=handle)
+        # キャッシュが使えない場合も、固定部分を先頭に置いて暗黙のプレフィックスキャッシュを効かせる
+        contents = [prefix, prompt] if prefix else prompt
+        return contents, types.GenerateContentConfig(system_instruction=system_instruction)
+
+
+class LocalContextCacheBackend(GeminiContextCacheBackend):
+    """
+    テスト用のローカル代替。APIにはキャッシュを作らず、ハンドルの発行と内容の保持だけを行う。
+    生成時はキャッシュ内容をその場で展開して送る。
+    """
+
+    def __init__(self):
+        self.caches = {}
+        self.created = 0
+
+    def is_too_small(self, model_name, system_instruction, prefix):
+        return False # ハンドルを使う経路を試せるように、大きさに関係なく作る
+
+    def create(self, model_name, system_instruction, prefix, ttl_seconds, display_name):
+        self.created += 1
+        name = f"localCachedContents/{display_name}-{self.created}"
+        self.caches[name] = (system_instruction, prefix)
+        return name
+
+    def request_args(self, handle, system_instruction, prefix, prompt):
+        if handle in self.caches:
+            system_instruction, prefix = self.caches[handle]
+        return super().request_args(None, system_instruction, prefix, prompt)
+
+
+def get_context_cache_backend():
+    """環境変数に応じたコンテキストキャッシュのバックエンドを返す (off の場合は None)"""
+    global context_cache_backend
+    mode = os.getenv("GEMINI_CONTEXT_CACHE", "gemini")
+    if mode == "off":
+        return None
+    if context_cache_backend is None:
+        with _context_caches_lock:
+            if context_cache_backend is None:
+                context_cache_backend = LocalContextCacheBackend() if mode == "local" else GeminiContextCacheBackend()
+    return context_cache_backend
+
+
+def get_context_cache(interpretation_type, system_instruction, prefix, model_name):
+    """
+    解釈タイプ・モデルごとのコンテキストキャッシュのハンドル名を返す。
+    初回と有効期限切れのときだけ作成し、作成に失敗した場合は None を返す
+    (失敗もTTLの間は記録しておき、毎回作成を試みないようにする)。
+    """
+    backend = get_context_cache_backend()
+    if backend is None or not interpretation_type:
+        return None
+
+    fingerprint = hashlib.sha256(f"{model_name}\0{system_instruction}\0{prefix}".encode("utf-8")).hexdigest()
+    # 固定部分のハッシュもキーに含めるので、言語 (ロケールパック) ごとに別のキャッシュになる
+    cache_key = (interpretation_type, model_name, fingerprint)
+    with _context_caches_lock:
+        now = time.time()
+        entry = _context_caches.get(cache_key)
+        if entry and entry["expires_at"] - CONTEXT_CACHE_REFRESH_MARGIN_SECONDS > now:
+            return entry["name"]
+        name = _create_context_cache(backend, interpretation_type, system_instruction, prefix, model_name)
+        _context_caches[cache_key] = {
+            "name": name,
+            "expires_at": now + CONTEXT_CACHE_TTL_SECONDS,
+        }
+        return name
+
+
+def _create_context_cache(backend, interpretation_type, system_instruction, prefix, model_name):
+    """コンテキストキャッシュを作成してハンドル名を返す。作らない・作れない場合は None"""
+    try:
+        if backend.is_too_small(model_name, system_instruction, prefix):
+            # 作成しても必ず失敗するので、APIを呼ばずに暗黙のキャッシュに任せる
+            print(f"固定部分が小さいためコンテキストキャッシュは作りません: {interpretation_type} / {model_name}")
+            name = None
+        else:
+            name = backend.create(model_name, system_instruction, prefix, CONTEXT_CACHE_TTL_SECONDS, f"tarot-{interpretation_type}")
+            print(f"コンテキストキャッシュを作成しました: {interpretation_type} / {model_name} ({name})")
+    except Exception as e:
+        print(f"コンテキストキャッシュを作成できませんでした ({interpretation_type}): {e}")
+        name = None
+    return name
+
+
+def drop_context_cache(name):
+    """
+    使えなくなったハンドルを記録から消す (次のリクエストで作り直す)。
+    他のスレッドがすでに新しいハンドルに置き換えたエントリは消さない。
+    """
+    with _context_caches_lock:
+        for cache_key, entry in list(_context_caches.items()):
+            if entry["name"] == name:
+                del _context_caches[cache_key]
+
+
+def generate_with_context_cache(model_name, interpretation_type, system_instruction, prefix, prompt):
+    """
+    コンテキストキャッシュを使って応答を生成する。
+    ハンドル付きの呼び出しが失敗した場合は、固定部分をそのまま送って1回だけやり直す。
+    やり直しが成功したら、サーバー側のキャッシュが消えている (削除・追い出し・時刻のずれ) とみなして
+    ハンドルを捨てる。やり直しも失敗した場合はハンドル以外の問題なので、そのまま例外にする。
+    """
+    backend = get_context_cache_backend() or GeminiContextCacheBackend()
+    handle = get_context_cache(interpretation_type, system_instruction, prefix, model_name)
+    contents, config = backend.request_args(handle, system_instruction, prefix, prompt)
+    try:
+        return model.models.generate_content(model = model_name, contents = contents, config = config)
+    except Exception as e:
+        if not handle:
+            raise
+        print(f"コンテキストキャッシュを使った呼び出しに失敗したため、キャッシュなしでやり直します ({handle}): {e}")
+    contents, config = backend.request_args(None, system_instruction, prefix, prompt)
+    response = model.models.generate_content(model = model_name, contents = contents, config = config)
+    drop_context_cache(handle)
+    return response
+
+
 # --- 応答生成関数 ---
-def generate_interpretation(prompt):
+def generate_interpretation(prompt, system_instruction=None, prefix=None, interpretation_type=None):
     """
     与えられたプロンプトに基づいてGeminiに応答を生成させる関数。
+    system_instruction と prefix (リクエスト間で変わらない部分) を渡すと、
+    可変部分の prompt とは分けて送り、解釈タイプごとのコンテキストキャッシュを使う。
+    モデルは interpretation_type とプロンプトの大きさから model_router が選ぶ。
+    応答を生成できなかった場合は GenerationError を送出する。
     """
     global model
 
     if model is None:
         print("エラー: Geminiモデルが初期化されていません。")
         if not initialize_gemini(): # 再度初期化を試みる
-            return "エラー: Geminiモデルの初期化に失敗しました。"
+            raise GenerationError("Geminiモデルの初期化に失敗しました。")
 
-    print("Geminiに応答を生成してもらっています...")
+    model_name = router.select(interpretation_type, len(prefix or "") + len(prompt))
+    print(f"Geminiに応答を生成してもらっています... ({model_name})")
+    started = time.perf_counter()
     try:
-        response = model.models.generate_content(
-            model = "gemini-2.0-flash-001", contents = prompt
-        )
+        if system_instruction is None and prefix is None:
+            response = model.models.generate_content(model = model_name, contents = prompt)
+        else:
+            response = generate_with_context_cache(
+                model_name, interpretation_type, system_instruction, prefix or "", prompt
+            )
+        router.record(model_name, time.perf_counter() - started, ok=True)
         print("Geminiからの応答取得完了。")
         return response.text
     except Exception as e:
+        router.record(model_name, time.perf_counter() - started, ok=False)
         print(f"Geminiからの応答生成中にエラーが発生しました: {e}")
-        return f"エラー: Geminiからの応答生成中に問題が発生しました。({e})"
+        raise GenerationError(str(e)) from e
 
 # --- 直接実行された場合のテストコード (オプション) ---
 if __name__ == '__main__':
     if initialize_gemini():
         test_prompt = "引いたタロットカードは「太陽」の正位置です。今日の運勢について教えてください。"
-        interpretation = generate_interpretation(test_prompt)
+        try:
+            interpretation = generate_interpretation(test_prompt)
+        except GenerationError as e:
+            interpretation = f"エラー: {e}"
         print("\n--- テスト応答 ---")
         print(interpretation)
         print("------------------")
@@ -0,0 +1,16 @@
+# gunicorn 用の設定ファイル (例: gunicorn app:app)
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", "4"))
+
+# フォーク前に app.py を読み込み、デッキスナップショット(mmap)を全ワーカーで共有する
+preload_app = True
+
+# 既定は同期ワーカー (1リクエストずつ処理し、timeout 秒で応答しないワーカーは再起動される)。
+# 最終解釈はジョブキューで実行し、ブラウザはポーリングするので同期ワーカーのままでよい。
+# SSE (/interpret/jobs/<id>/events) を使う場合は TAROT_JOB_EVENTS=sse を設定し、
+# GUNICORN_WORKER_CLASS=gthread (と GUNICORN_THREADS) でスレッドワーカーにすること。
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
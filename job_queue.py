@@ -0,0 +1,248 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# --- ローカルのジョブキュー ---
+# 時間のかかる解釈 (最終総合解釈) をHTTPリクエストの外で実行するためのキュー。
+# 外部のブローカーは使わず、SQLite (WALモード) のファイルにジョブを保存し、
+# 各プロセスのワーカースレッドが取り出して実行する。
+#   - ジョブはファイルに残るので、プロセスが再起動しても失われない
+#   - 実行中のジョブには期限 (lease) を付け、期限切れのものは別のワーカーが再実行する
+#   - handler が例外を送出したジョブは JOB_MAX_ATTEMPTS 回まで再試行し、それでも失敗したら failed にする
+JOB_LEASE_SECONDS = 300 # 実行中は延長し続ける。延長が止まって期限が切れたら、ワーカーが落ちたとみなす
+JOB_MAX_ATTEMPTS = 3
+JOB_RESULT_TTL_SECONDS = 24 * 60 * 60 # 完了したジョブを保持する時間
+JOB_POLL_SECONDS = 1.0
+
+
+class JobQueue:
+    """ジョブをファイルに保存し、ワーカースレッドで handler(payload) を実行するキュー"""
+
+    def __init__(self, db_path, handler, num_workers=2, lease_seconds=JOB_LEASE_SECONDS):
+        self.db_path = db_path
+        self.handler = handler
+        self.num_workers = num_workers
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        # isolation_level=None にして、トランザクションは明示的に BEGIN する
+        conn = sqlite3.connect(self.db_path, timeout=10.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL," # queued / running / done / failed
+            " payload TEXT NOT NULL,"
+            " result TEXT,"
+            " error TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " lease_expires REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    # --- ワーカーの起動 ---
+    def ensure_started(self):
+        """
+        このプロセスのワーカースレッドを起動する (起動済みなら何もしない)。
+        フォーク前に起動したスレッドは子プロセスに引き継がれないため、プロセスIDで判定する。
+        """
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for i in range(self.num_workers):
+                threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True).start()
+
+    # --- ジョブの登録・参照 ---
+    def submit(self, payload):
+        """ジョブを登録し、ジョブIDを返す"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO jobs (id, status, payload, created_at) VALUES (?, 'queued', ?, ?)",
+            (job_id, json.dumps(payload, ensure_ascii=False), now),
+        )
+        # 古い完了済みジョブはここでついでに削除する
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (now - JOB_RESULT_TTL_SECONDS,),
+        )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """ジョブの状態を返す。存在しなければ None"""
+        row = self._connect().execute(
+            "SELECT id, status, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = {"job_id": row["id"], "status": row["status"]}
+        if row["status"] == "queued":
+            job["position"] = self._connect().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (row["created_at"],)
+            ).fetchone()[0]
+        if row["status"] == "done":
+            job["result"] = json.loads(row["result"])
+        if row["status"] == "failed":
+            job["error"] = row["error"]
+        return job
+
+    def stats(self):
+        """キューの深さ・実行中の件数・待ち時間 (秒) を返す"""
+        now = time.time()
+        conn = self._connect()
+        queued, oldest = conn.execute(
+            "SELECT COUNT(*), MIN(created_at) FROM jobs WHERE status = 'queued'"
+        ).fetchone()
+        running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+        # 直近1時間に開始したジョブの、登録から開始までの平均待ち時間
+        avg_wait = conn.execute(
+            "SELECT AVG(started_at - created_at) FROM jobs WHERE started_at > ?", (now - 3600,)
+        ).fetchone()[0]
+        return {
+            "queued": queued,
+            "running": running,
+            "oldest_wait_seconds": now - oldest if oldest else 0.0,
+            "avg_wait_seconds": avg_wait or 0.0,
+        }
+
+    # --- ワーカー ---
+    def _claim(self):
+        """実行待ち (または期限切れで放置された) ジョブを1件取り出して running にする"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs"
+                " WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?)"
+                " ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["attempts"] >= JOB_MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    ("最大試行回数に達しました。", now, row["id"]),
+                )
+                conn.execute("COMMIT")
+                return self._claim()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+                " started_at = COALESCE(started_at, ?), lease_expires = ? WHERE id = ?",
+                (now, now + self.lease_seconds, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return row["id"], json.loads(row["payload"]), row["attempts"] + 1
+
+    # 結果の書き込みは、このワーカーの取り出し (attempts が同じ) のまま running の場合だけ行う。
+    # lease が切れて別のワーカーが再実行している場合、古い実行の結果で上書きしない。
+    def _finish(self, job_id, attempts, result):
+        cur = self._connect().execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished_at = ?, lease_expires = NULL"
+            " WHERE id = ? AND status = 'running' AND attempts = ?",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id, attempts),
+        )
+        return cur.rowcount > 0
+
+    def _fail(self, job_id, attempts, error):
+        """
+        失敗したジョブを JOB_MAX_ATTEMPTS 回までは queued に戻して再試行し、それを超えたら failed にする。
+        再試行するかどうかを返す。
+        """
+        now = time.time()
+        retry = attempts < JOB_MAX_ATTEMPTS
+        if retry:
+            sql, params = "status = 'queued', error = ?, lease_expires = NULL", (error,)
+        else:
+            sql, params = "status = 'failed', error = ?, finished_at = ?, lease_expires = NULL", (error, now)
+        cur = self._connect().execute(
+            f"UPDATE jobs SET {sql} WHERE id = ? AND status = 'running' AND attempts = ?",
+            params + (job_id, attempts),
+        )
+        return retry and cur.rowcount > 0
+
+    def _run(self, job_id, attempts, payload):
+        """
+        handler を実行する。実行中は lease_seconds の 1/3 ごとに lease を延長し、
+        時間のかかる解釈が lease 切れで別のワーカーに二重に実行されないようにする。
+        (プロセスが落ちた場合は延長が止まるので、これまで通り lease 切れで再実行される)
+        """
+        done = threading.Event()
+
+        def keep_lease():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    self._connect().execute(
+                        "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                        (time.time() + self.lease_seconds, job_id, attempts),
+                    )
+                except sqlite3.Error as e:
+                    print(f"ジョブ {job_id} の lease を延長できませんでした: {e}")
+
+        threading.Thread(target=keep_lease, name=f"job-lease-{job_id[:8]}", daemon=True).start()
+        try:
+            return self.handler(payload)
+        finally:
+            done.set()
+
+    def _worker_loop(self):
+        # このループは終わらせない (スレッドが止まると、このプロセスではジョブが処理されなくなる)。
+        # 結果を書き込めなかったジョブは running のまま残り、lease が切れたら再実行される。
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"ジョブの取り出し中にエラーが発生しました: {e}")
+                job = None
+            if job is None:
+                # 同じプロセスで登録されたらすぐ起きる。他のプロセスの登録は定期的に確認する
+                self._wakeup.wait(JOB_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            job_id, payload, attempts = job
+            try:
+                result = self._run(job_id, attempts, payload)
+            except Exception as e:
+                error = str(e) or repr(e) # 空のメッセージの例外でも失敗が分かるようにする
+                print(f"ジョブ {job_id} の実行中にエラーが発生しました ({attempts}/{JOB_MAX_ATTEMPTS}回目): {error}")
+                try:
+                    if self._fail(job_id, attempts, error):
+                        self._wakeup.set()
+                except sqlite3.Error as db_error:
+                    print(f"ジョブ {job_id} の失敗を記録できませんでした: {db_error}")
+                continue
+            try:
+                if not self._finish(job_id, attempts, result):
+                    print(f"ジョブ {job_id} は別のワーカーが再実行しているため、この結果は書き込みません。")
+            except sqlite3.Error as e:
+                print(f"ジョブ {job_id} の結果を書き込めませんでした: {e}")
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+
+from shared_cache import load_deck_snapshot
+
+# --- ロケールパック ---
+# locales/<ロケール>/pack.json に、言語ごとのカードデータの場所・ポジション名・
+# システム指示・プロンプトのテンプレート・エラー表示・CLIの文言をまとめる。
+# パックは最初に使われたときに読み込み、カードデータはデッキスナップショット (mmap) に変換する。
+# 使われていない言語のデータはメモリに載らない。
+# カードの並び順 (カードID) は全ロケールで共通にすること (カード画像のマニフェストもこのIDを使う)。
+DEFAULT_LOCALE = "ja"
+LOCALES_DIR = os.path.join(os.path.dirname(__file__), "locales")
+SNAPSHOT_DIR = os.environ.get("TAROT_SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), "instance"))
+
+_packs = {}
+_packs_lock = threading.Lock()
+
+
+def load_card_data(filepath):
+    """カードデータのJSONを読み込む。失敗した場合は None"""
+    # スクリプトのディレクトリからの相対パスでファイルを開く
+    script_dir = os.path.dirname(__file__)
+    abs_file_path = os.path.join(script_dir, filepath)
+    try:
+        with open(abs_file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print(f"エラー: ファイルが見つかりません - {abs_file_path}")
+        return None
+    except json.JSONDecodeError:
+        print(f"エラー: JSONファイルの解析に失敗しました - {abs_file_path}")
+        return None
+
+
+def available_locales():
+    """pack.json があるロケールの一覧"""
+    try:
+        return sorted(
+            name for name in os.listdir(LOCALES_DIR)
+            if os.path.exists(os.path.join(LOCALES_DIR, name, "pack.json"))
+        )
+    except FileNotFoundError:
+        return []
+
+
+AVAILABLE_LOCALES = available_locales()
+
+
+class LocalePack:
+    """1つの言語のカードデータ・ポジション名・プロンプトをまとめたもの"""
+
+    def __init__(self, code, pack, deck):
+        self.code = code
+        self.language = pack["language"]
+        self.deck = deck
+        self.positions = pack["positions"]
+        self.orientations = pack["orientations"]
+        self.system_instruction = pack["system_instruction"]
+        self.prompt_prefixes = pack["prompt_prefixes"]
+        self.templates = pack["templates"]
+        self.messages = pack["messages"]
+        self.cli = pack["cli"]
+
+    def position_name(self, index):
+        """ポジション名 (定義がない場合は「n枚目」)"""
+        if index < len(self.positions):
+            return self.positions[index]
+        return self.templates["position_fallback"].format(number=index + 1)
+
+
+def _load_locale_pack(code):
+    pack = load_card_data(os.path.join(LOCALES_DIR, code, "pack.json"))
+    if pack is None:
+        return None
+    cards = load_card_data(pack["cards"])
+    if cards is None:
+        return None
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    deck = load_deck_snapshot(cards, os.path.join(SNAPSHOT_DIR, f"cards.{code}.snapshot"))
+    return LocalePack(code, pack, deck if deck is not None else cards)
+
+
+def get_locale_pack(code=None):
+    """
+    ロケールパックを返す (初回のみ読み込む)。
+    未対応のロケールは DEFAULT_LOCALE にする。読み込みに失敗した場合は None。
+    """
+    code = code if code in AVAILABLE_LOCALES else DEFAULT_LOCALE
+    pack = _packs.get(code)
+    if pack is not None:
+        return pack
+    with _packs_lock:
+        if code not in _packs:
+            print(f"ロケールパックを読み込んでいます: {code}")
+            pack = _load_locale_pack(code)
+            if pack is None:
+                return None # 失敗は記録せず、次回もう一度試す
+            _packs[code] = pack
+        return _packs[code]
@@ -1,200 +1,118 @@
-import google.generativeai as genai
-import os
-import random
-import json
+import argparse
 import traceback
 
-# タロットカードの情報を読み込み
-with open("cards_meaning/all_cards.json", mode="r", encoding="utf-8") as f:
-    cards_meaning = json.load(f)
+from gemini import initialize_gemini, GenerationError
+from locales import get_locale_pack, AVAILABLE_LOCALES, DEFAULT_LOCALE
+from reading import draw_card, build_interpretation_prompt, generate_reading
 
-def setup_gemini_model():
-    """APIキーを取得し、Geminiモデルを初期化する"""
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-    if not GOOGLE_API_KEY:
-        print("エラー: 環境変数 'GOOGLE_API_KEY' が設定されていません。")
-        return None
+# 対話式タロット占い (CLI版)
+# 文言・カードデータ・プロンプトはロケールパック (locales/<言語>/pack.json) から読み込み、
+# Webアプリ (app.py) と同じ reading.py の処理で占う。
+# 使い方: python main.py [--lang en]
 
-    try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        return genai.GenerativeModel("gemini-1.5-pro")
-    except Exception as e:
-        print(f"Gemini APIの初期化でエラー: {e}")
-        return None
-
-def select_card(cards, num):
-    """指定された枚数のカードをランダムに選択する"""
-    cards_copy = cards.copy()  # 元のリストを変更しないようにコピー
-    positions = ["meaning_up", "meaning_rev"]
-    selected_cards = []
-    
-    for _ in range(min(num, len(cards_copy))):
-        card_details = random.choice(cards_copy)
-        position = random.choice(positions)
-        selected_cards.append([position, card_details])
-        cards_copy.remove(card_details)
-    
-    return selected_cards
-
-import time
-
-def safe_generate_content(model, prompt, max_retries=3):
-    """レート制限を考慮したコンテンツ生成関数"""
-    retries = 0
-    while retries < max_retries:
-        try:
-            return model.generate_content(prompt)
-        except google.api_core.exceptions.ResourceExhausted as e:
-            # レート制限エラーの場合
-            if "429" in str(e):
-                retry_delay = 10  # デフォルト待機時間
-                # エラーメッセージから待機時間を抽出する試み
-                import re
-                delay_match = re.search(r"retry_delay\s*{\s*seconds:\s*(\d+)", str(e))
-                if delay_match:
-                    retry_delay = int(delay_match.group(1)) + 1
-                
-                print(f"APIレート制限に達しました。{retry_delay}秒待機します...")
-                time.sleep(retry_delay)
-                retries += 1
-            else:
-                raise
-        except Exception as e:
-            print(f"エラーが発生しました: {e}")
-            raise
-    
-    raise Exception(f"最大再試行回数({max_retries})に達しました。")
 
-def create_interactive_tarot(model, question):
+def create_interactive_tarot(pack, question):
     """対話形式のタロット占いを行う"""
-    positions = ["現在の状況、状態", "障害、原因", "現状維持で予想される傾向", "問題解決のための対策", "最終結果"]
-    
-
-    print("カードを選んでいます...")
-    selected_cards = select_card(cards_meaning, len(positions))
-    
-    print(f"\n========== タロット占い：{question if question else '全体運'} ==========\n")
-    print("これからカードを1枚ずつ解説していきます。あなたの反応を伺いながら進めていきますね。\n")
-    
-    # カードごとの対話を保存するコンテキスト
-    dialogue_context = []
-    posit = {"meaning_up": "正位置",
-             "meaning_rev": "逆位置"}
-    
+    cli = pack.cli
+    base_request = {"question": question} if question else {}
+
+    print(cli["selecting"])
+    print(cli["title"].format(topic=question if question else cli["general_topic"]))
+    print(cli["intro"])
+
+    drawn_cards = []
+    # カードごとの対話を保存するコンテキスト (Webアプリの card_interactions と同じ形式)
+    card_interactions = []
+
     # 各カードごとに対話形式で解釈
-    for i, (card_position, card_details) in enumerate(selected_cards):
-        position_name = positions[i]
-        card_name = card_details['name']
-        card_meaning = card_details[card_position]
-        
-        print(f"\n----- 「{position_name}」のカード -----")
-        print(f"『{card_name}』が{posit[card_position]}で出ました。")
-        print(f"このカードの意味: {card_meaning}\n")
-        # AIによる最初の解釈
-        prompt = f"""
-あなたは対話形式で占いを進める経験豊富なタロット占い師です。
-相談内容：{question if question else '全体的な運勢'}
-現在、「{position_name}」を示す位置に{card_position}の「{card_name}」が出ています。
-意味：{card_meaning}
-
-このカードについて、相談者に問いかけるように優しく解説し、
-「このカードはあなたの現状に当てはまりますか？」といった質問を投げかけてください。
-回答は200字以内でお願いします。
-"""
+    for i in range(len(pack.positions)):
+        card = draw_card(pack, exclude={c["card_id"] for c in drawn_cards})
+        drawn_cards.append(card)
+
+        print(cli["card_header"].format(position=pack.position_name(i)))
+        print(cli["card_drawn"].format(card_name=card["card_name"], orientation=card["orientation"]))
+        print(cli["card_meaning"].format(meaning=card["meaning"]))
 
+        turns = []
+        card_interactions.append(turns)
         try:
-            response = safe_generate_content(model, prompt)
-            print(f"占い師: {response.text}\n")
-            
-            # Userがyキーを押すまでループ
+            # AIによる最初の解釈
+            _, prompt = build_interpretation_prompt(pack, drawn_cards, dict(base_request, type="single", card_index=i))
+            interpretation = generate_reading(pack, "single", prompt)
+            print(cli["reader"].format(text=interpretation))
+            turns.append({"interpretation": interpretation})
+
+            # ユーザーがEnterだけを押すまで対話を続ける
             while True:
-                user_response = input("あなたの反応を入力してください (終了するにはEnterだけ): ")
+                user_response = input(cli["reaction_input"])
                 if user_response.strip() == '':
-                    print("次のカードに移りますね。")
+                    print(cli["next_card"])
                     break
-                else:
-                    pass
-            
-            
-                # 対話を記録
-                dialogue_context.append({
-                    "position": position_name,
-                    "card": card_name,
-                    "position_type": card_position,
-                    "meaning": card_meaning,
-                    "ai_comment": response.text,
-                    "user_response": user_response
-                })
-            
-                # ユーザーの反応を踏まえたAIの解釈
-                follow_up_prompt = f"""
-相談者の反応：「{user_response}」
-
-相談者の反応を踏まえて、「{position_name}」のカード「{card_name}」({card_position})についての
-より個人化された解釈を提供してください。相談者の具体的な状況に寄り添った内容にしてください。
-回答は200字以内でお願いします。
-"""
-                follow_up_response = safe_generate_content(model, follow_up_prompt)
-                print(f"\n占い師: {follow_up_response.text}")
-            
-                dialogue_context[-1]["ai_follow_up"] = follow_up_response.text
-            
+
+                # ユーザーの反応を踏まえたAIの応答
+                _, prompt = build_interpretation_prompt(pack, drawn_cards, dict(
+                    base_request, type="feedback", card_index=i, feedback=user_response, card_interactions=turns
+                ))
+                reaction = generate_reading(pack, "feedback", prompt)
+                print("\n" + cli["reader"].format(text=reaction))
+                turns.append({"feedback": user_response, "reaction": reaction})
+
+        except GenerationError as e:
+            print(cli["error"].format(error=e))
         except Exception as e:
-            print(f"エラーが発生しました: {e}")
+            print(cli["error"].format(error=e))
             traceback.print_exc()
-    
+
     # 全カードの解釈が終わった後に総合的な解釈を提供
-    print("\n\n===== すべてのカードの解釈が終わりました =====")
-    print("最終的な総合解釈を生成しています...\n")
-    
-    # 総合解釈用のプロンプトを作成
-    final_prompt = f"相談内容：{question if question else '全体的な運勢やアドバイス'}\n\n"
-    final_prompt += "この占いで出たカードと相談者との対話の内容:\n"
-    
-    for dialogue in dialogue_context:
-        final_prompt += f"""
-位置: {dialogue['position']}
-カード: {dialogue['card']} ({dialogue['position_type']})
-カードの意味: {dialogue['meaning']}
-相談者の反応: {dialogue['user_response']}
-"""
-    
-    final_prompt += """
-上記の一連のカードと対話の内容を踏まえて、カード同士の関連性も考慮した総合的な解釈とアドバイスを提供してください。
-相談者が前向きになれるような、具体的で洞察に満ちた優しいメッセージにしてください。
-"""
-    
+    print(cli["all_done"])
+    print(cli["generating_final"])
+
     try:
-        final_response = safe_generate_content(model, final_prompt)
-        print("\n----- 総合的な解釈 -----")
-        print(final_response.text)
-        print("-------------------------")
+        _, prompt = build_interpretation_prompt(pack, drawn_cards, dict(
+            base_request, type="final", card_interactions=card_interactions
+        ))
+        final_text = generate_reading(pack, "final", prompt)
+        print(cli["final_header"])
+        print(final_text)
+        print(cli["final_footer"])
         return True
+    except GenerationError as e:
+        print(cli["final_error"].format(error=e))
+        return False
     except Exception as e:
-        print(f"総合解釈の生成中にエラーが発生しました: {e}")
+        print(cli["final_error"].format(error=e))
         traceback.print_exc()
         return False
 
-def main():
+
+def main(locale=DEFAULT_LOCALE):
     """メインプログラム"""
+    pack = get_locale_pack(locale)
+    if pack is None:
+        print("カードデータの読み込みに失敗したため、プログラムを終了します。")
+        return
+    cli = pack.cli
+
     # モデルの初期化
-    model = setup_gemini_model()
-    if not model:
-        print("モデルの初期化に失敗したため、プログラムを終了します。")
+    if not initialize_gemini():
+        print(cli["init_failed"])
         return
-    
-    print("=== 対話式タロット占い ===")
-    print("さて、今日は何を占いましょうか？")
-    
+
+    print(cli["banner"])
+    print(cli["greeting"])
+
     # 相談内容の入力
-    question = input("占いたい内容を入力してください (例: 恋愛運、仕事運、全体運など。入力なしでEnterも可): ")
+    question = input(cli["question_input"])
     question = question.strip() or None
-    
+
     # 対話式タロット占いを実行
-    success = create_interactive_tarot(model, question)
-    
+    success = create_interactive_tarot(pack, question)
+
     if not success:
-        print("\n占いの過程でエラーが発生しました。もう一度お試しください。")
+        print(cli["failed"])
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="対話式タロット占い")
+    parser.add_argument("--lang", choices=AVAILABLE_LOCALES, default=DEFAULT_LOCALE, help="使用する言語")
+    main(parser.parse_args().lang)
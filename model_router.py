@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from collections import deque, defaultdict
+
+# --- 解釈タイプごとのモデル選択 ---
+# model_routes.json (環境変数 MODEL_ROUTES_PATH で変更可) に解釈タイプごとのモデルを定義する。
+#   - model          : 通常使うモデル
+#   - fallback       : 通常のモデルが遅い・エラーが多いときに切り替える速いモデル
+#   - size_overrides : プロンプトの文字数が min_chars 以上のときに使うモデル (大きい順に判定)
+# 直近 window 件のレイテンシのp95、またはエラー率が閾値を超えたモデルは fallback に切り替える。
+# max_sample_age_seconds より古い記録は捨てるので、切り替え後しばらくすると通常のモデルに戻る。
+# レイテンシ・エラー率の統計はプロセスごと (gunicornではワーカーごと) に保持し、切り替えもワーカーごとに判断する。
+# モデル選択の回数 (tarot_model_route_total) は、use_counter_store() でカウンタの保存先を渡すと全ワーカーの合計になる
+# (app.py では解釈キャッシュの SQLite を使う)。渡さない場合はプロセスごとに数える。
+ROUTE_COUNTER_PREFIX = "route|"
+
+DEFAULT_ROUTE_CONFIG = {
+    "routes": {
+        "default": {"model": "gemini-2.0-flash-001", "fallback": "gemini-2.0-flash-lite-001"},
+    },
+    "fallback_policy": {
+        "window": 50,
+        "min_samples": 10,
+        "p95_latency_seconds": 20.0,
+        "error_rate": 0.2,
+        "max_sample_age_seconds": 300,
+    },
+}
+
+
+def load_route_config(filepath=None):
+    """モデル選択の設定を読み込む。読み込めない場合は既定の設定を返す"""
+    script_dir = os.path.dirname(__file__)
+    filepath = filepath or os.environ.get("MODEL_ROUTES_PATH", os.path.join(script_dir, "model_routes.json"))
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        print(f"モデル設定ファイルが見つからないため既定の設定を使います - {filepath}")
+        return DEFAULT_ROUTE_CONFIG
+    except json.JSONDecodeError:
+        print(f"エラー: モデル設定ファイルの解析に失敗しました - {filepath}")
+        return DEFAULT_ROUTE_CONFIG
+    config.setdefault("routes", {}).setdefault("default", DEFAULT_ROUTE_CONFIG["routes"]["default"])
+    policy = dict(DEFAULT_ROUTE_CONFIG["fallback_policy"])
+    policy.update(config.get("fallback_policy", {}))
+    config["fallback_policy"] = policy
+    return config
+
+
+class ModelRouter:
+    """解釈タイプ・プロンプトの大きさ・観測したレイテンシからモデルを選ぶクラス"""
+
+    def __init__(self, config):
+        self.routes = config["routes"]
+        self.policy = config["fallback_policy"]
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.policy["window"])) # モデル -> [(時刻, 秒, 成功したか)]
+        self._decisions = defaultdict(int) # (解釈タイプ, モデル, 理由) -> 回数 (保存先がない場合)
+        self.counter_store = None
+
+    def use_counter_store(self, store):
+        """モデル選択の回数を count(name) / counts() を持つ共有の保存先で数える"""
+        self.counter_store = store
+
+    def _route(self, interpretation_type):
+        return self.routes.get(interpretation_type) or self.routes["default"]
+
+    def select(self, interpretation_type, prompt_chars=0):
+        """使うモデル名を返し、選んだ理由をメトリクスに記録する"""
+        route = self._route(interpretation_type)
+        model_name, reason = route["model"], "primary"
+
+        overrides = sorted(route.get("size_overrides", []), key=lambda o: o["min_chars"], reverse=True)
+        for override in overrides:
+            if prompt_chars >= override["min_chars"]:
+                model_name, reason = override["model"], "size"
+                break
+
+        fallback = route.get("fallback")
+        if fallback and fallback != model_name and self._is_degraded(model_name):
+            model_name, reason = fallback, "fallback"
+
+        decision = (interpretation_type or "default", model_name, reason)
+        if self.counter_store is not None:
+            self.counter_store.count(ROUTE_COUNTER_PREFIX + "|".join(decision))
+        else:
+            with self._lock:
+                self._decisions[decision] += 1
+        return model_name
+
+    def record(self, model_name, latency_seconds, ok):
+        """1回の呼び出し結果 (所要時間と成否) を記録する"""
+        with self._lock:
+            self._samples[model_name].append((time.time(), latency_seconds, ok))
+
+    def model_stats(self, model_name):
+        """直近の呼び出しのp95レイテンシ・エラー率・件数を返す"""
+        oldest = time.time() - self.policy["max_sample_age_seconds"]
+        with self._lock:
+            samples = [(latency, ok) for t, latency, ok in self._samples.get(model_name, ()) if t >= oldest]
+        if not samples:
+            return {"p95_latency_seconds": 0.0, "error_rate": 0.0, "samples": 0}
+        latencies = sorted(latency for latency, _ in samples)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        errors = sum(1 for _, ok in samples if not ok)
+        return {"p95_latency_seconds": p95, "error_rate": errors / len(samples), "samples": len(samples)}
+
+    def _is_degraded(self, model_name):
+        stats = self.model_stats(model_name)
+        if stats["samples"] < self.policy["min_samples"]:
+            return False
+        return (stats["p95_latency_seconds"] > self.policy["p95_latency_seconds"]
+                or stats["error_rate"] > self.policy["error_rate"])
+
+    def decisions(self):
+        """(解釈タイプ, モデル, 理由) ごとのモデル選択の回数"""
+        if self.counter_store is None:
+            with self._lock:
+                return dict(self._decisions)
+        return {
+            tuple(name[len(ROUTE_COUNTER_PREFIX):].split("|")): count
+            for name, count in self.counter_store.counts().items()
+            if name.startswith(ROUTE_COUNTER_PREFIX)
+        }
+
+    def metrics_text(self):
+        """
+        モデル選択の結果と各モデルの統計をPrometheusのテキスト形式で返す。
+        レイテンシ・エラー率はこのプロセスの値なので worker ラベルを付ける
+        (ワーカーごとの値が必要な場合は、ワーカーごとに取得すること)。
+        """
+        decisions = self.decisions()
+        with self._lock:
+            models = list(self._samples)
+        worker = os.getpid()
+        lines = [
+            "# HELP tarot_model_route_total Model routing decisions by interpretation type and reason (all workers).",
+            "# TYPE tarot_model_route_total counter",
+        ]
+        for (interpretation_type, model_name, reason), count in sorted(decisions.items()):
+            lines.append(
+                f'tarot_model_route_total{{type="{interpretation_type}",model="{model_name}",reason="{reason}"}} {count}'
+            )
+        lines += [
+            "# HELP tarot_model_latency_p95_seconds p95 latency over the recent window, per worker process.",
+            "# TYPE tarot_model_latency_p95_seconds gauge",
+        ]
+        stats = {model_name: self.model_stats(model_name) for model_name in sorted(models)}
+        for model_name, s in stats.items():
+            lines.append(f'tarot_model_latency_p95_seconds{{model="{model_name}",worker="{worker}"}} {s["p95_latency_seconds"]:.3f}')
+        lines += [
+            "# HELP tarot_model_error_rate Error rate over the recent window, per worker process.",
+            "# TYPE tarot_model_error_rate gauge",
+        ]
+        for model_name, s in stats.items():
+            lines.append(f'tarot_model_error_rate{{model="{model_name}",worker="{worker}"}} {s["error_rate"]:.3f}')
+        return "\n".join(lines) + "\n"
+
+
+router = ModelRouter(load_route_config())
@@ -0,0 +1,127 @@
+import random
+
+from gemini import generate_interpretation
+
+# --- 占いの共通処理 ---
+# Webアプリ (app.py) と CLI (main.py) の両方から使う。
+# 言語ごとの文言はすべてロケールパック (locales.py) から取り出す。
+
+
+def draw_card(pack, rng=random, exclude=()):
+    """
+    デッキからカードを1枚引き、向きを決めて返す。
+    exclude にカードIDを渡すと、そのカード以外から引く (CLIでは同じカードを2回引かない)。
+    """
+    deck = pack.deck
+    if exclude:
+        card_id = rng.choice([i for i in range(len(deck)) if i not in exclude])
+    else:
+        card_id = rng.randrange(len(deck)) # カード画像 (static/cards/manifest.json) のキーにもなる
+    card_info = deck[card_id]
+    reversed_ = rng.choice([False, True])
+    return {
+        "card_id": card_id,
+        "card_name": card_info.get("name", ""),
+        "orientation": pack.orientations["reversed" if reversed_ else "upright"],
+        "reversed": reversed_,
+        "meaning": card_info.get("meaning_rev" if reversed_ else "meaning_up", ""),
+    }
+
+
+def build_interpretation_prompt(pack, drawn_cards, data):
+    """
+    リクエストの内容から (解釈タイプ, プロンプト) を返す。
+    必要な情報が不足している場合、プロンプトは None になる。
+    ここで組み立てるのはカードや対話などの可変部分だけ。
+    共通の指示はロケールパックのシステム指示・プレフィックスとして別に送る。
+    """
+    t = pack.templates
+    user_question = data.get('question', t['default_question'])
+    interpretation_type = data.get('type', 'final') # 'single', 'feedback', 'final'
+    card_index = data.get('card_index', -1) # 'single', 'feedback' で使用
+    user_feedback = data.get('feedback', '')
+    # 'feedback' と 'final' で使用する対話履歴 (各カードごとのターンの配列)
+    card_interactions = data.get('card_interactions', [])
+
+    if interpretation_type == 'single' and 0 <= card_index < len(drawn_cards):
+        # --- 個別カード解釈用プロンプト ---
+        target_card = drawn_cards[card_index]
+        prompt_context = ""
+        if card_index > 0:
+            prompt_context += t['single_context_header']
+            for i in range(card_index):
+                prev_card = drawn_cards[i]
+                prompt_context += t['single_context_line'].format(
+                    position=pack.position_name(i), card_name=prev_card['card_name'], orientation=prev_card['orientation']
+                )
+            prompt_context += "\n"
+        prompt = t['single'].format(
+            number=card_index + 1, position=pack.position_name(card_index),
+            card_name=target_card['card_name'], orientation=target_card['orientation'],
+            meaning=target_card['meaning'], context=prompt_context, question=user_question,
+        )
+
+    elif interpretation_type == 'feedback' and 0 <= card_index < len(drawn_cards) and user_feedback and card_interactions:
+        # --- AI反応生成用プロンプト (複数回の対話を考慮) ---
+        target_card = drawn_cards[card_index]
+
+        # このカードに関する直近の対話履歴を構築
+        interaction_log = ""
+        for turn in card_interactions:
+            if turn.get('interpretation'): # 最初の解釈
+                interaction_log += t['feedback_log_interpretation'].format(text=turn['interpretation'])
+            if turn.get('feedback'):
+                interaction_log += t['feedback_log_feedback'].format(text=turn['feedback'])
+            if turn.get('reaction'):
+                interaction_log += t['feedback_log_reaction'].format(text=turn['reaction'])
+
+        prompt = t['feedback'].format(
+            number=card_index + 1, position=pack.position_name(card_index),
+            card_name=target_card['card_name'], orientation=target_card['orientation'],
+            log=interaction_log, feedback=user_feedback,
+        )
+
+    elif interpretation_type == 'final' and len(drawn_cards) == 5 and card_interactions: # card_interactions は全カードの対話履歴の配列
+        # --- 最終総合解釈用プロンプト (複数回の対話履歴を反映) ---
+        prompt_cards_info = ""
+        for i, card in enumerate(drawn_cards):
+            prompt_cards_info += t['final_card_line'].format(
+                position=pack.position_name(i), card_name=card['card_name'],
+                orientation=card['orientation'], meaning=card['meaning'],
+            )
+
+        prompt_interaction_summary = t['final_summary_header']
+        # card_interactions は [[card0_turn1, card0_turn2,...], [card1_turn1,...], ...] の形式を想定
+        for i, card_history in enumerate(card_interactions):
+            if not card_history: continue # 対話がないカードはスキップ
+            prompt_interaction_summary += t['final_summary_card'].format(
+                position=pack.position_name(i), card_name=drawn_cards[i]['card_name']
+            )
+            for turn_num, turn in enumerate(card_history):
+                if turn.get('interpretation'):
+                    prompt_interaction_summary += t['final_summary_interpretation'].format(text=turn['interpretation'][:100])
+                if turn.get('feedback'):
+                    prompt_interaction_summary += t['final_summary_feedback'].format(turn=turn_num + 1, text=turn['feedback'])
+                if turn.get('reaction'):
+                    prompt_interaction_summary += t['final_summary_reaction'].format(turn=turn_num + 1, text=turn['reaction'])
+            prompt_interaction_summary += "\n"
+
+        prompt = t['final'].format(cards=prompt_cards_info, question=user_question, summary=prompt_interaction_summary)
+    else:
+        # 不正なリクエスト
+        return interpretation_type, None
+
+    return interpretation_type, prompt
+
+
+def generate_reading(pack, interpretation_type, prompt):
+    """
+    ロケールパックのシステム指示・プレフィックスを付けてGeminiに応答を生成させる。
+    失敗した場合は gemini.GenerationError を送出する (表示する文言はパックの messages から取る)。
+    """
+    return generate_interpretation(
+        prompt,
+        system_instruction=pack.system_instruction,
+        prefix=pack.prompt_prefixes[interpretation_type],
+        interpretation_type=interpretation_type,
+    )
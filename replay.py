@@ -0,0 +1,507 @@
+import argparse
+import contextlib
+import difflib
+import functools
+import glob
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+
+# 記録した占いを再実行して、出力と性能の変化を検出する
+#
+# replays/readings/*.json の占い (シード・相談内容・カードごとのフィードバック・記録したLLMの応答) を、
+# Flaskのテストクライアントで実際のルート (/draw_card, /interpret, /interpret/jobs) に通して再実行する。
+# LLMは記録した応答を順に返す再生用クライアントに差し替え、次の点が記録と一致するか確認する。
+#   - 引いたカード (カードID・向き)
+#   - LLMに送ったプロンプトと固定部分 (システム指示・プレフィックス)
+#   - 各ルートが返したHTML (Markdown変換の結果)
+# あわせて段階ごと (カードを引く・プロンプト生成・LLM呼び出し・Markdown変換・ルート全体) の
+# CPU時間 (time.thread_time) と tracemalloc のピークメモリを計測し、
+# replays/baseline.json と比べて閾値を超えて悪化していたら終了コード 1 で終了する。
+#
+# 使い方:
+#   python replay.py                    # 再生して一致と性能を確認する
+#   python replay.py --update-baseline  # 現在の計測値をベースラインとして保存する
+#   python replay.py --bless            # 記録した応答はそのままに、カード・プロンプト・HTMLの期待値を更新する
+#   python replay.py --record FILE      # 本物のGeminiで応答を録り直す (GOOGLE_API_KEY が必要)
+#
+# 新しい占いを記録するには、locale・seed・question・feedback だけを書いたファイルを
+# replays/readings/ に置いて --record で応答を録る。
+
+REPLAY_DIR = os.path.join(os.path.dirname(__file__), "replays")
+READINGS_GLOB = os.path.join(REPLAY_DIR, "readings", "*.json")
+BASELINE_PATH = os.path.join(REPLAY_DIR, "baseline.json")
+
+# --- 悪化とみなす閾値 ---
+# 小さい値は揺れが大きいので、比率に加えて絶対値の余裕を持たせる
+CPU_REGRESSION_RATIO = 1.5
+CPU_SLACK_MS = 2.0
+MEMORY_REGRESSION_RATIO = 1.25
+MEMORY_SLACK_KB = 64
+JOB_TIMEOUT_SECONDS = 30
+
+
+class ReplayError(Exception):
+    pass
+
+
+def sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# --- 段階ごとの計測 ---
+class StageProfiler:
+    """
+    段階ごとのCPU時間 (スレッド単位) とピークメモリを集計する。
+    段階は入れ子にでき、外側の段階には内側の段階の分も含まれる。
+    tracemalloc のピークはプロセス全体で1つなので、内側の段階でリセットする前に外側へ引き継ぐ。
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.cpu = defaultdict(float)
+        self.peak = defaultdict(int)
+        self.calls = defaultdict(int)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._local.__dict__.setdefault("stack", [])
+        frame = {"start": 0, "peak": 0}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["start"] = current
+        stack.append(frame)
+        started = time.thread_time()
+        try:
+            yield
+        finally:
+            cpu = time.thread_time() - started
+            stack.pop()
+            peak = 0
+            if self.trace_memory:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            with self._lock:
+                self.cpu[name] += cpu
+                self.calls[name] += 1
+                self.peak[name] = max(self.peak[name], peak - frame["start"])
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+# --- LLMの差し替え ---
+def sent_request(contents, config):
+    """generate_content に渡された内容から (プロンプト, 固定部分のハッシュ) を取り出す"""
+    if isinstance(contents, list):
+        prefix, prompt = ("", contents[0]) if len(contents) == 1 else (contents[0], contents[-1])
+    else:
+        prefix, prompt = "", contents
+    system_instruction = getattr(config, "system_instruction", None) or ""
+    return prompt, sha256(f"{system_instruction}\0{prefix}")
+
+
+class ReplayClient:
+    """記録した応答を呼び出し順に返す、genai.Client の代わり"""
+
+    def __init__(self, steps):
+        self.models = self
+        self.steps = steps
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        prompt, context_sha256 = sent_request(contents, config)
+        with self._lock:
+            index = len(self.calls)
+            self.calls.append({"prompt": prompt, "context_sha256": context_sha256})
+        if index >= len(self.steps) or "response" not in self.steps[index]:
+            raise ReplayError(f"{index + 1}回目の呼び出しに対応する応答が記録されていません。")
+        return SimpleNamespace(text=self.steps[index]["response"])
+
+
+class RecordingClient:
+    """本物の genai.Client に中継し、送ったプロンプトと応答を記録する"""
+
+    def __init__(self, client):
+        self.client = client
+        self.models = self
+        self.caches = client.caches
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        prompt, context_sha256 = sent_request(contents, config)
+        with self._lock:
+            self.calls.append({"prompt": prompt, "context_sha256": context_sha256, "response": response.text})
+        return response
+
+
+# --- アプリの読み込みと計測用の差し替え ---
+def load_app(work_dir):
+    """
+    作業用ディレクトリを使うように環境変数を設定してから app を読み込む。
+    共有キャッシュが残っているとLLMが呼ばれずに再生がずれるので、キャッシュ・ジョブは毎回新しく作る。
+    コンテキストキャッシュは local にして、固定部分が毎回 contents に含まれるようにする。
+    """
+    os.environ["TAROT_CACHE_PATH"] = os.path.join(work_dir, "interpretation_cache.sqlite3")
+    os.environ["TAROT_JOBS_PATH"] = os.path.join(work_dir, "jobs.sqlite3")
+    os.environ["TAROT_SNAPSHOT_DIR"] = work_dir
+    os.environ["GEMINI_CONTEXT_CACHE"] = "local"
+    import app as app_module
+    return app_module
+
+
+@contextlib.contextmanager
+def instrument(app_module, profiler, cache_path):
+    """app の各段階を計測用の関数に差し替え、終わったら元に戻す"""
+    import markdown
+    from shared_cache import InterpretationCache
+
+    job_done = threading.Event()
+    jobs = app_module.interpretation_jobs
+    original_handler = jobs.handler
+
+    def handler(payload):
+        try:
+            with profiler.stage("job:final"):
+                return original_handler(payload)
+        finally:
+            job_done.set()
+
+    cache = InterpretationCache(cache_path)
+    cache.get = profiler.wrap("cache", cache.get)
+    cache.set = profiler.wrap("cache", cache.set)
+    patches = [
+        (app_module, "draw_card_from", profiler.wrap("draw", app_module.draw_card_from)),
+        (app_module, "build_interpretation_prompt", profiler.wrap("prompt", app_module.build_interpretation_prompt)),
+        (app_module, "generate_reading", profiler.wrap("llm", app_module.generate_reading)),
+        (app_module, "interpretation_cache", cache),
+        (app_module.router, "counter_store", cache),
+        (markdown, "markdown", profiler.wrap("markdown", markdown.markdown)),
+        (jobs, "handler", handler),
+    ]
+    originals = [(target, name, getattr(target, name)) for target, name, _ in patches]
+    for target, name, value in patches:
+        setattr(target, name, value)
+    try:
+        yield job_done
+    finally:
+        for target, name, value in originals:
+            setattr(target, name, value)
+        cache.flush_counts() # 作業用ディレクトリを消す前に書き込んでおく
+
+
+# --- 再生 ---
+def post_json(client, profiler, stage, url, payload=None):
+    with profiler.stage(stage):
+        response = client.post(url, json=payload) if payload is not None else client.post(url)
+    data = response.get_json(silent=True) or {}
+    if response.status_code >= 400:
+        raise ReplayError(f"{url} がエラーを返しました ({response.status_code}): {data.get('error')}")
+    return data
+
+
+def replay_reading(app_module, reading, profiler, job_done):
+    """
+    1回分の占いをブラウザ (templates/index.html) と同じ順序・内容のリクエストで再実行する。
+    (引いたカード, 各LLM呼び出しに対応する (解釈タイプ, 返されたHTML) の一覧) を返す。
+    """
+    client = app_module.app.test_client()
+    client.get(f"/?lang={reading.get('locale', 'ja')}")
+    client.post("/reset")
+    random.seed(reading["seed"])
+    question = reading.get("question", "")
+    draws, outputs = [], []
+    # ブラウザと同じく、カードごとに1ターンだけ持ち、フィードバックは同じターンを上書きする
+    interactions = [[] for _ in reading["feedback"]]
+
+    for index, feedbacks in enumerate(reading["feedback"]):
+        card = post_json(client, profiler, "request:draw_card", "/draw_card")["new_card"]
+        draws.append({"card_id": card["card_id"], "card_name": card["card_name"], "reversed": card["reversed"]})
+
+        html = post_json(client, profiler, "request:single", "/interpret", {
+            "question": question, "type": "single", "card_index": index,
+        })["interpretation_html"]
+        interactions[index].append({"interpretation": html})
+        outputs.append(("single", html))
+
+        for feedback in feedbacks:
+            interactions[index][-1]["feedback"] = feedback
+            html = post_json(client, profiler, "request:feedback", "/interpret", {
+                "question": question, "type": "feedback", "card_index": index,
+                "feedback": feedback, "card_interactions": interactions[index],
+            })["reaction_html"]
+            interactions[index][-1]["reaction"] = html
+            outputs.append(("feedback", html))
+
+    job_done.clear()
+    job = post_json(client, profiler, "request:final", "/interpret/jobs", {
+        "question": question, "card_interactions": interactions,
+    })
+    # ポーリングのメモリ確保がジョブ側の計測に混ざらないよう、ジョブが終わるまでは待つだけにする
+    if not job_done.wait(JOB_TIMEOUT_SECONDS):
+        raise ReplayError("最終解釈のジョブが時間内に終わりませんでした。")
+    deadline = time.time() + JOB_TIMEOUT_SECONDS
+    while True:
+        status = client.get(job["status_url"]).get_json()
+        if status["status"] == "done":
+            outputs.append(("final", status["result"]["interpretation_html"]))
+            break
+        if status["status"] == "failed" or time.time() > deadline:
+            raise ReplayError(f"最終解釈のジョブが失敗しました: {status.get('error')}")
+        time.sleep(0.01)
+    return draws, outputs
+
+
+def run_reading(app_module, reading, llm, profiler, cache_path, verbose=False):
+    """計測用の差し替えをした状態で1回分の占いを再生する (verbose でなければアプリの出力は捨てる)"""
+    import gemini
+    gemini.model = llm
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with instrument(app_module, profiler, cache_path) as job_done, output:
+        with profiler.stage("reading"):
+            return replay_reading(app_module, reading, profiler, job_done)
+
+
+def compare(reading, draws, outputs, calls):
+    """記録との差分を文字列の一覧で返す (一致すれば空)"""
+    problems = []
+    if draws != reading.get("draws"):
+        problems.append(f"引いたカードが違います\n  記録: {reading.get('draws')}\n  再生: {draws}")
+    steps = reading.get("steps", [])
+    if len(calls) != len(steps) or len(outputs) != len(steps):
+        problems.append(f"LLMの呼び出し回数が違います (記録: {len(steps)}回, 再生: {len(calls)}回)")
+    for i, (step, call, (kind, html)) in enumerate(zip(steps, calls, outputs)):
+        label = f"{i + 1}回目 ({kind})"
+        if call["prompt"] != step.get("prompt"):
+            diff = difflib.unified_diff(
+                (step.get("prompt") or "").splitlines(), call["prompt"].splitlines(),
+                "記録", "再生", lineterm="", n=1,
+            )
+            problems.append(f"{label}: プロンプトが違います\n" + "\n".join(list(diff)[:40]))
+        if call["context_sha256"] != step.get("context_sha256"):
+            problems.append(f"{label}: システム指示・プレフィックスが違います")
+        if sha256(html) != step.get("html_sha256"):
+            problems.append(f"{label}: 返されたHTMLが違います")
+    return problems
+
+
+def recorded_steps(calls, outputs):
+    return [
+        {"type": kind, "prompt": call["prompt"], "context_sha256": call["context_sha256"],
+         "response": call["response"], "html_sha256": sha256(html)}
+        for call, (kind, html) in zip(calls, outputs)
+    ]
+
+
+def load_readings(paths):
+    readings = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            readings.append((path, json.load(f)))
+    return readings
+
+
+def save_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+# --- 記録の作成・更新 ---
+def update_readings(app_module, readings, work_dir, live, verbose):
+    """
+    --record: 本物のGeminiで応答を録り、期待値も書き込む。
+    --bless : 記録した応答を再生して、カード・プロンプト・HTMLの期待値だけを書き直す。
+    """
+    import gemini
+    if live and not gemini.initialize_gemini():
+        print("エラー: Geminiを初期化できないため記録できません。")
+        return False
+    for n, (path, reading) in enumerate(readings):
+        steps = reading.get("steps", [])
+        llm = RecordingClient(gemini.model) if live else ReplayClient(steps)
+        cache_path = os.path.join(work_dir, f"update-{n}.sqlite3")
+        try:
+            draws, outputs = run_reading(app_module, reading, llm, StageProfiler(), cache_path, verbose)
+        except ReplayError as e:
+            print(f"{path}: {e}")
+            return False
+        if live:
+            calls = llm.calls
+        else:
+            if len(llm.calls) != len(steps):
+                print(f"{path}: 記録された応答の数 ({len(steps)}) と呼び出し回数 ({len(llm.calls)}) が違います。--record で録り直してください。")
+                return False
+            calls = [dict(call, response=step["response"]) for call, step in zip(llm.calls, steps)]
+        reading["draws"] = draws
+        reading["steps"] = recorded_steps(calls, outputs)
+        save_json(path, reading)
+        print(f"{path}: カード{len(draws)}枚・LLM呼び出し{len(calls)}回を記録しました。")
+    return True
+
+
+# --- 性能の比較 ---
+def measure(app_module, readings, work_dir, repeat, verbose):
+    """
+    1回目 (ウォームアップ) で記録と一致するか確認してから、CPU時間を repeat 回計測して中央値をとる。
+    tracemalloc はCPU時間を大きく増やすので、メモリは別に1回だけ計測する。
+    一致しなかった場合は (差分の一覧, None) を返す。
+    """
+    cpu_runs = []
+    memory = None
+    calls = defaultdict(int)
+    for run in range(repeat + 2):
+        trace_memory = run == repeat + 1
+        warmup = run == 0
+        profiler = StageProfiler(trace_memory=trace_memory)
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            for n, (path, reading) in enumerate(readings):
+                llm = ReplayClient(reading.get("steps", []))
+                cache_path = os.path.join(work_dir, f"cache-{run}-{n}.sqlite3")
+                try:
+                    draws, outputs = run_reading(app_module, reading, llm, profiler, cache_path, verbose)
+                except ReplayError as e:
+                    return [f"{path}: {e}"], None
+                if warmup:
+                    problems = compare(reading, draws, outputs, llm.calls)
+                    if problems:
+                        return [f"{path}: {p}" for p in problems], None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        if trace_memory:
+            memory = dict(profiler.peak)
+        elif not warmup:
+            cpu_runs.append(dict(profiler.cpu))
+            calls = profiler.calls
+
+    stages = {}
+    for name in sorted(calls):
+        stages[name] = {
+            "calls": calls[name],
+            "cpu_ms": round(statistics.median(r.get(name, 0.0) for r in cpu_runs) * 1000, 3),
+            "peak_kb": round(memory.get(name, 0) / 1024, 1),
+        }
+    return [], stages
+
+
+def find_regressions(stages, baseline, cpu_ratio, memory_ratio):
+    regressions = []
+    for name, base in baseline["stages"].items():
+        current = stages.get(name)
+        if current is None:
+            # 段階の名前を変えたり消したりしたときに、比較が黙って外れないようにする
+            regressions.append(f"{name}: ベースラインにある段階が計測されませんでした (意図した変更なら --update-baseline で更新してください)")
+            continue
+        cpu_limit = base["cpu_ms"] * cpu_ratio + CPU_SLACK_MS
+        if current["cpu_ms"] > cpu_limit:
+            regressions.append(f"{name}: CPU時間 {current['cpu_ms']:.2f}ms > 上限 {cpu_limit:.2f}ms (ベースライン {base['cpu_ms']:.2f}ms)")
+        memory_limit = base["peak_kb"] * memory_ratio + MEMORY_SLACK_KB
+        if current["peak_kb"] > memory_limit:
+            regressions.append(f"{name}: ピークメモリ {current['peak_kb']:.1f}KB > 上限 {memory_limit:.1f}KB (ベースライン {base['peak_kb']:.1f}KB)")
+    return regressions
+
+
+def print_stages(stages, baseline):
+    base_stages = baseline["stages"] if baseline else {}
+    print(f"{'段階':<20}{'回数':>6}{'CPU(ms)':>12}{'基準':>12}{'ピーク(KB)':>14}{'基準':>12}")
+    for name, s in stages.items():
+        base = base_stages.get(name, {})
+        base_cpu = f"{base['cpu_ms']:.2f}" if base else "-"
+        base_peak = f"{base['peak_kb']:.1f}" if base else "-"
+        print(f"{name:<20}{s['calls']:>6}{s['cpu_ms']:>12.2f}{base_cpu:>12}{s['peak_kb']:>14.1f}{base_peak:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録した占いの再生と性能の回帰チェック")
+    parser.add_argument("readings", nargs="*", help="再生する記録 (既定: replays/readings/*.json)")
+    parser.add_argument("--repeat", type=int, default=5, help="CPU時間を計測する回数 (中央値をとる)")
+    parser.add_argument("--update-baseline", action="store_true", help="計測値を replays/baseline.json に保存する")
+    parser.add_argument("--bless", action="store_true", help="記録した応答を使って期待値を更新する")
+    parser.add_argument("--record", action="store_true", help="本物のGeminiで応答を録り直す")
+    parser.add_argument("--cpu-ratio", type=float, default=CPU_REGRESSION_RATIO, help="CPU時間の許容倍率")
+    parser.add_argument("--memory-ratio", type=float, default=MEMORY_REGRESSION_RATIO, help="ピークメモリの許容倍率")
+    parser.add_argument("-v", "--verbose", action="store_true", help="アプリのログも表示する")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat は1以上にしてください")
+
+    paths = args.readings or sorted(glob.glob(READINGS_GLOB))
+    if not paths:
+        print("エラー: 再生する記録がありません。")
+        return 1
+    readings = load_readings(paths)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        app_module = load_app(work_dir)
+
+        if args.record or args.bless:
+            return 0 if update_readings(app_module, readings, work_dir, args.record, args.verbose) else 1
+
+        problems, stages = measure(app_module, readings, work_dir, args.repeat, args.verbose)
+        if problems:
+            print("記録と一致しませんでした (意図した変更なら --bless で期待値を更新してください):")
+            for problem in problems:
+                print(f"- {problem}")
+            return 1
+        print(f"{len(readings)}件の占いが記録と一致しました。")
+
+    baseline = None
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_stages(stages, baseline)
+
+    if args.update_baseline:
+        save_json(BASELINE_PATH, {
+            "python": platform.python_version(),
+            "repeat": args.repeat,
+            "readings": [os.path.relpath(p, REPLAY_DIR) for p in paths],
+            "stages": stages,
+        })
+        print(f"ベースラインを保存しました: {BASELINE_PATH}")
+        return 0
+    if baseline is None:
+        print("ベースラインがないため性能は比較しませんでした (--update-baseline で作成できます)。")
+        return 0
+    if baseline.get("python") != platform.python_version():
+        print(f"注意: ベースラインは Python {baseline.get('python')} で計測したものです。")
+
+    regressions = find_regressions(stages, baseline, args.cpu_ratio, args.memory_ratio)
+    if regressions:
+        print("性能が悪化しています:")
+        for regression in regressions:
+            print(f"- {regression}")
+        return 1
+    print("性能はベースラインの範囲内です。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import atexit
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+# --- デッキスナップショット ---
+# all_cards.json を「読み取り専用のバイナリ」に変換し、mmap で開く。
+# gunicorn の --preload でフォーク前に開いておけば、全ワーカーが同じページキャッシュを共有する。
+# (Pythonのdict/strはrefcount更新でコピーオンライトが発生するため、JSONのままでは共有されない)
+#
+# フォーマット:
+#   ヘッダ  : MAGIC(4byte) + カード枚数(uint32)
+#   索引    : カードごとに (offset, length) x 3フィールド (uint32)
+#   データ  : UTF-8 文字列を連結したもの
+SNAPSHOT_MAGIC = b"TDK1"
+SNAPSHOT_FIELDS = ("name", "meaning_up", "meaning_rev")
+_HEADER = struct.Struct("<4sI")
+_ENTRY = struct.Struct("<" + "II" * len(SNAPSHOT_FIELDS))
+
+
+def build_deck_snapshot(cards, snapshot_path):
+    """カードデータのリストをスナップショット形式でファイルに書き出す"""
+    index = bytearray()
+    data = bytearray()
+    data_start = _HEADER.size + _ENTRY.size * len(cards)
+    for card in cards:
+        entry = []
+        for field in SNAPSHOT_FIELDS:
+            encoded = card.get(field, "").encode("utf-8")
+            entry += [data_start + len(data), len(encoded)]
+            data += encoded
+        index += _ENTRY.pack(*entry)
+
+    # 書き込み途中のファイルを他のプロセスが読まないよう、一時ファイル経由で置き換える
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, len(cards)))
+        f.write(index)
+        f.write(data)
+    os.replace(tmp_path, snapshot_path)
+
+
+class DeckSnapshot:
+    """
+    mmap したスナップショットをカードのリストのように扱うクラス。
+    random.choice() や len() にそのまま渡せる。カードは参照時にdictとして組み立てる。
+    """
+
+    def __init__(self, snapshot_path):
+        with open(snapshot_path, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._buf, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self._buf.close()
+            raise ValueError(f"デッキスナップショットの形式が不正です - {snapshot_path}")
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("カードのインデックスが範囲外です。")
+        entry = _ENTRY.unpack_from(self._buf, _HEADER.size + _ENTRY.size * i)
+        card = {}
+        for n, field in enumerate(SNAPSHOT_FIELDS):
+            offset, length = entry[2 * n], entry[2 * n + 1]
+            card[field] = self._buf[offset:offset + length].decode("utf-8")
+        return card
+
+
+def load_deck_snapshot(cards, snapshot_path):
+    """
+    スナップショットが存在しないかJSONと内容が異なる場合は作り直してから mmap で開く。
+    失敗した場合は None を返し、呼び出し側で通常のリストを使う。
+    """
+    try:
+        if not os.path.exists(snapshot_path) or os.path.getsize(snapshot_path) == 0:
+            build_deck_snapshot(cards, snapshot_path)
+        deck = DeckSnapshot(snapshot_path)
+        if len(deck) != len(cards) or any(deck[i] != _snapshot_fields(card) for i, card in enumerate(cards)):
+            build_deck_snapshot(cards, snapshot_path)
+            deck = DeckSnapshot(snapshot_path)
+        return deck
+    except (OSError, ValueError, struct.error) as e:
+        print(f"デッキスナップショットの読み込みに失敗しました: {e}")
+        return None
+
+
+def _snapshot_fields(card):
+    return {field: card.get(field, "") for field in SNAPSHOT_FIELDS}
+
+
+# --- ワーカー間で共有する解釈キャッシュ ---
+# SQLite (WALモード) を使い、全ワーカーが同じファイルを読み書きする。
+# 接続はフォーク後にプロセスごと・スレッドごとに開き直す。
+# 期限切れの行は set() のついでに削除する。
+# ヒット数などのカウンタはプロセスのメモリに溜めておき、set() のとき・一定件数または一定時間ごとに
+# まとめて書き込む (読み込みのたびに書き込みトランザクションを発生させない)。
+CACHE_TTL_SECONDS = 24 * 60 * 60
+STATS_FLUSH_COUNT = 100
+STATS_FLUSH_SECONDS = 10
+
+
+class InterpretationCache:
+    """プロンプトをキーにしてLLMの応答をワーカー間で共有するキャッシュ"""
+
+    def __init__(self, db_path, ttl=CACHE_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._pending = {} # カウンタ名 -> まだ書き込んでいない増分
+        self._pending_pid = os.getpid()
+        self._pending_lock = threading.Lock()
+        self._last_flush = time.time()
+        atexit.register(self.flush_counts)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_path, timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS interpretations ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS interpretations_created_at ON interpretations (created_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        conn.commit()
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(*parts):
+        """プロンプトなどの構成要素からキャッシュキー(sha256)を作る"""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update((part or "").encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """キャッシュされた応答を返す。なければ None"""
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM interpretations WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"解釈キャッシュの読み込みでエラー: {e}")
+            return None
+        self.count("hits" if row else "misses")
+        return row[0] if row else None
+
+    def set(self, key, value):
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO interpretations (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            # 期限切れの行はここでついでに削除する
+            conn.execute("DELETE FROM interpretations WHERE created_at <= ?", (now - self.ttl,))
+            self._write_counts(conn) # 同じトランザクションでカウンタも書き込む
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"解釈キャッシュの書き込みでエラー: {e}")
+
+    def stats(self):
+        """全ワーカー合計のヒット数・ミス数・ヒット率を返す"""
+        rows = self.counts()
+        hits, misses = rows.get("hits", 0), rows.get("misses", 0)
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+    # --- 全ワーカー共通のカウンタ ---
+    def count(self, name, n=1):
+        """カウンタを増やす (このプロセスのメモリに溜め、まとめて書き込む)"""
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                # フォーク前の親プロセスの分は親が書き込むので引き継がない
+                self._pending = {}
+                self._pending_pid = os.getpid()
+                self._last_flush = time.time()
+            self._pending[name] = self._pending.get(name, 0) + n
+            due = (sum(self._pending.values()) >= STATS_FLUSH_COUNT
+                   or time.time() - self._last_flush >= STATS_FLUSH_SECONDS)
+        if due:
+            self.flush_counts()
+
+    def counts(self):
+        """全ワーカー合計のカウンタを {名前: 値} で返す (このプロセスの未書き込み分も書き込んでから読む)"""
+        self.flush_counts()
+        try:
+            return dict(self._connect().execute("SELECT name, count FROM stats").fetchall())
+        except sqlite3.Error as e:
+            print(f"解釈キャッシュの統計取得でエラー: {e}")
+            return {}
+
+    def flush_counts(self):
+        """溜めておいたカウンタを書き込む"""
+        if not self._pending or self._pending_pid != os.getpid():
+            return
+        try:
+            conn = self._connect()
+            if self._write_counts(conn):
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"解釈キャッシュの統計書き込みでエラー: {e}")
+
+    def _write_counts(self, conn):
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                return False
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return False
+        try:
+            conn.executemany(
+                "INSERT INTO stats (name, count) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET count = count + excluded.count",
+                list(pending.items()),
+            )
+        except sqlite3.Error:
+            # 書き込めなかった分は戻して次回に回す
+            with self._pending_lock:
+                for name, n in pending.items():
+                    self._pending[name] = self._pending.get(name, 0) + n
+            raise
+        return True